@@ -1,10 +1,22 @@
-from flask import Flask
-
-def create_app():
-    app = Flask(__name__)
-    app.config['SECRET_KEY'] = 'your_secret_key_here'  # Change this in production
-
-    from .route import main as main_blueprint
-    app.register_blueprint(main_blueprint)
-
-    return app
+from flask import Flask
+
+def create_app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'your_secret_key_here'  # Change this in production
+    app.config['DASHBOARD_CACHE_TTL'] = 60  # Seconds the shared dashboard data is reused
+    app.config['CATALOG_CACHE_MAX_AGE'] = 60  # Seconds proxies may reuse anonymous catalog pages
+    app.config['CART_BACKEND'] = 'mysql'  # 'mysql' (Cart_Item table) or 'memory' (single process only)
+
+    from . import db
+    db.init_app(app)
+
+    from . import catalog
+    catalog.init_app(app)
+
+    from .route import main as main_blueprint
+    app.register_blueprint(main_blueprint)
+
+    from .commands import register_commands
+    register_commands(app)
+
+    return app
\ No newline at end of file
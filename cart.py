@@ -0,0 +1,242 @@
+import secrets
+import threading
+
+from flask import current_app, g, session
+from werkzeug.local import LocalProxy
+
+from app.catalog import product_cache
+from app.db import get_db_connection
+
+
+# --- Cart stores ---
+# A cart is {product_id: quantity} kept server side under a cart key:
+# 'user:<person_id>' once logged in, 'session:<random id>' before that.
+# Only the random id lives in the session cookie.
+
+class MySQLCartStore:
+    def get(self, cart_key):
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT product_id, quantity FROM Cart_Item WHERE cart_key = %s', (cart_key,))
+            rows = cursor.fetchall()
+        conn.close()
+        return {row['product_id']: row['quantity'] for row in rows}
+
+    def add_many(self, cart_key, items):
+        # items: {product_id: quantity to add}
+        rows = [(cart_key, product_id, quantity) for product_id, quantity in items.items() if quantity > 0]
+        if not rows:
+            return
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.executemany('''
+                INSERT INTO Cart_Item (cart_key, product_id, quantity)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    quantity = quantity + VALUES(quantity)
+            ''', rows)
+        conn.commit()
+        conn.close()
+
+    def set_many(self, cart_key, items):
+        # items: {product_id: new quantity}; zero or less removes the product
+        rows = [(cart_key, product_id, quantity) for product_id, quantity in items.items() if quantity > 0]
+        removed = [product_id for product_id, quantity in items.items() if quantity <= 0]
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            if rows:
+                cursor.executemany('''
+                    INSERT INTO Cart_Item (cart_key, product_id, quantity)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        quantity = VALUES(quantity)
+                ''', rows)
+            if removed:
+                self._delete(cursor, cart_key, removed)
+        conn.commit()
+        conn.close()
+
+    def remove_many(self, cart_key, product_ids):
+        if not product_ids:
+            return
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            self._delete(cursor, cart_key, product_ids)
+        conn.commit()
+        conn.close()
+
+    def clear(self, cart_key):
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('DELETE FROM Cart_Item WHERE cart_key = %s', (cart_key,))
+        conn.commit()
+        conn.close()
+
+    def merge(self, from_key, to_key):
+        # Move every line of from_key into to_key, adding up quantities
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO Cart_Item (cart_key, product_id, quantity)
+                SELECT %s, ci.product_id, ci.quantity
+                FROM Cart_Item ci
+                WHERE ci.cart_key = %s
+                ON DUPLICATE KEY UPDATE
+                    quantity = quantity + VALUES(quantity)
+            ''', (to_key, from_key))
+            cursor.execute('DELETE FROM Cart_Item WHERE cart_key = %s', (from_key,))
+        conn.commit()
+        conn.close()
+
+    def _delete(self, cursor, cart_key, product_ids):
+        product_ids = list(product_ids)
+        cursor.execute(f"DELETE FROM Cart_Item WHERE cart_key = %s AND product_id IN ({', '.join(['%s'] * len(product_ids))})",
+                       [cart_key] + product_ids)
+
+
+class MemoryCartStore:
+    # Process-local stand-in for development and single-process setups
+    def __init__(self):
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def get(self, cart_key):
+        with self._lock:
+            return dict(self._carts.get(cart_key, {}))
+
+    def add_many(self, cart_key, items):
+        with self._lock:
+            cart = self._carts.setdefault(cart_key, {})
+            for product_id, quantity in items.items():
+                if quantity > 0:
+                    cart[product_id] = cart.get(product_id, 0) + quantity
+
+    def set_many(self, cart_key, items):
+        with self._lock:
+            cart = self._carts.setdefault(cart_key, {})
+            for product_id, quantity in items.items():
+                if quantity > 0:
+                    cart[product_id] = quantity
+                else:
+                    cart.pop(product_id, None)
+
+    def remove_many(self, cart_key, product_ids):
+        with self._lock:
+            cart = self._carts.get(cart_key, {})
+            for product_id in product_ids:
+                cart.pop(product_id, None)
+
+    def clear(self, cart_key):
+        with self._lock:
+            self._carts.pop(cart_key, None)
+
+    def merge(self, from_key, to_key):
+        with self._lock:
+            source = self._carts.pop(from_key, {})
+            cart = self._carts.setdefault(to_key, {})
+            for product_id, quantity in source.items():
+                cart[product_id] = cart.get(product_id, 0) + quantity
+
+
+CART_STORES = {
+    'mysql': MySQLCartStore(),
+    'memory': MemoryCartStore(),
+}
+
+
+def get_cart_store():
+    return CART_STORES[current_app.config.get('CART_BACKEND', 'mysql')]
+
+
+def cart_key(create=False):
+    # None for a visitor who has never put anything in a cart
+    if 'user_id' in session:
+        return f"user:{session['user_id']}"
+    if 'cart_sid' not in session:
+        if not create:
+            return None
+        session['cart_sid'] = secrets.token_urlsafe(16)
+    return f"session:{session['cart_sid']}"
+
+
+def get_cart():
+    # The current visitor's cart, read once per request
+    cart = g.get('cart_contents')
+    if cart is None:
+        if 'cart' in session:
+            # Cart saved in the cookie by an older version of the app
+            legacy = session.pop('cart')
+            # An empty legacy cart must not create a cart id for the visitor
+            if legacy:
+                get_cart_store().add_many(cart_key(create=True), {int(pid): qty for pid, qty in legacy.items()})
+        key = cart_key()
+        cart = get_cart_store().get(key) if key else {}
+        g.cart_contents = cart
+    return cart
+
+
+def update_cart(add=None, set_quantities=None, remove=None, clear=False):
+    # Bulk cart changes for the current visitor; each argument maps or lists product ids
+    store = get_cart_store()
+    key = cart_key(create=True)
+    if clear:
+        store.clear(key)
+    if add:
+        store.add_many(key, add)
+    if set_quantities:
+        store.set_many(key, set_quantities)
+    if remove:
+        store.remove_many(key, remove)
+    g.pop('cart_contents', None)
+    forget_cart_pricing()
+
+
+def merge_session_cart(session_cart_sid):
+    # Call right after login: the anonymous cart joins the user's cart
+    if session_cart_sid:
+        get_cart_store().merge(f'session:{session_cart_sid}', cart_key())
+        g.pop('cart_contents', None)
+        forget_cart_pricing()
+
+
+# --- Pricing ---
+
+def price_cart(cart):
+    # cart: {product_id: quantity}. Archived products are left out.
+    cached = product_cache.get_many(cart.keys())
+    cart_items = []
+    total = 0
+    for product_id in sorted(cached):
+        product = cached[product_id]
+        if not product['is_active']:
+            continue
+        quantity = cart[product_id]
+        subtotal = product['price'] * quantity
+        total += subtotal
+        cart_items.append({
+            'product': product,
+            'quantity': quantity,
+            'subtotal': subtotal
+        })
+    return {'cart_items': cart_items, 'total': total}
+
+
+def get_cart_pricing():
+    # The cart priced once per request, shared by the route and every
+    # template rendered during the request
+    pricing = g.get('cart_pricing')
+    if pricing is None:
+        cart = get_cart()
+        pricing = price_cart(cart) if cart else {'cart_items': [], 'total': 0}
+        g.cart_pricing = pricing
+    return pricing
+
+
+def forget_cart_pricing():
+    # Call after changing the cart if the same request renders it again
+    g.pop('cart_pricing', None)
+
+
+# Template-facing values: nothing is priced until a template touches them
+lazy_cart_items = LocalProxy(lambda: get_cart_pricing()['cart_items'])
+lazy_cart_total = LocalProxy(lambda: get_cart_pricing()['total'])
@@ -0,0 +1,640 @@
+import base64
+import json
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from decimal import Decimal
+
+from app.cache import LRUCache, admin_widget_cache, category_cache, invalidate_category_cache, invalidate_dashboard_cache
+from app.db import borrow_connection, get_db_connection
+
+# InnoDB does not index words shorter than innodb_ft_min_token_size (default 3)
+FULLTEXT_MIN_TOKEN = 3
+PRODUCT_FULLTEXT_COLUMNS = 'p.product_name, p.brand, p.product_description'
+
+
+def search_tokens(search):
+    return re.findall(r'\w+', search.lower())
+
+
+def product_search(search):
+    # Build the WHERE condition and relevance score for a catalog search.
+    # Every word must match (AND), each word also matches as a prefix, and
+    # rows are scored by the FULLTEXT index over name, brand and description.
+    # Returns (condition, condition_params, relevance, relevance_params).
+    tokens = search_tokens(search)
+    indexed = [t for t in tokens if len(t) >= FULLTEXT_MIN_TOKEN]
+    short = [t for t in tokens if len(t) < FULLTEXT_MIN_TOKEN]
+
+    conditions = []
+    params = []
+    relevance = '0'
+    relevance_params = []
+    if indexed:
+        boolean_query = ' '.join(f'+{token}*' for token in indexed)
+        match = f'MATCH({PRODUCT_FULLTEXT_COLUMNS}) AGAINST (%s IN BOOLEAN MODE)'
+        conditions.append(match)
+        params.append(boolean_query)
+        relevance = match
+        relevance_params.append(boolean_query)
+    # Words too short for the index must start a word in any searched column
+    for token in short:
+        word_matches = []
+        for column in PRODUCT_FULLTEXT_COLUMNS.split(', '):
+            word_matches.append(f'{column} LIKE %s OR {column} LIKE %s')
+            params.extend([f'{token}%', f'% {token}%'])
+        conditions.append('(' + ' OR '.join(word_matches) + ')')
+    if not conditions:
+        # Nothing searchable (punctuation only): keep the old substring match
+        conditions.append('(p.product_name LIKE %s OR p.brand LIKE %s)')
+        params.extend([f'%{search}%', f'%{search}%'])
+    return '(' + ' AND '.join(conditions) + ')', params, relevance, relevance_params
+
+
+# --- Keyset pagination ---
+
+PRODUCTS_PER_PAGE = 24
+MAX_PRODUCTS_PER_PAGE = 96
+# Storefront sort -> (sort key expression, direction); product_id breaks ties
+# in the same direction. None stands for the search relevance expression.
+PRODUCT_SORTS = {
+    'newest': (None, 'DESC'),
+    'price_asc': ('p.price', 'ASC'),
+    'price_desc': ('p.price', 'DESC'),
+    'name_asc': ('p.product_name', 'ASC'),
+    'name_desc': ('p.product_name', 'DESC'),
+    'relevance': (None, 'DESC'),
+}
+
+
+def encode_cursor(sort, row):
+    key = row['relevance'] if sort == 'relevance' else row.get(sort_key_field(sort))
+    if isinstance(key, Decimal):
+        key = str(key)
+    payload = json.dumps([sort, key, row['product_id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    # Returns (key, product_id), or None for a missing, malformed or
+    # stale cursor (one issued for a different sort order)
+    if not cursor:
+        return None
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, product_id = json.loads(payload)
+    except (ValueError, TypeError):
+        return None
+    if cursor_sort != sort or not isinstance(product_id, int) or isinstance(product_id, bool):
+        return None
+    # Keys are bound as SQL parameters: only scalars are allowed
+    if key is not None and (not isinstance(key, (str, int, float)) or isinstance(key, bool)):
+        return None
+    return key, product_id
+
+
+def sort_key_field(sort):
+    column, _ = PRODUCT_SORTS[sort]
+    return column.split('.', 1)[1] if column else None
+
+
+def keyset_condition(sort, position, relevance='0', relevance_params=()):
+    # WHERE fragment selecting the rows that come after position in sort order
+    column, direction = PRODUCT_SORTS[sort]
+    op = '<' if direction == 'DESC' else '>'
+    key, product_id = position
+    if sort == 'newest':
+        return f'p.product_id {op} %s', [product_id]
+    if sort == 'relevance':
+        column = relevance
+        return (f'({column} {op} %s OR ({column} = %s AND p.product_id {op} %s))',
+                list(relevance_params) + [key] + list(relevance_params) + [key, product_id])
+    return f'({column} {op} %s OR ({column} = %s AND p.product_id {op} %s))', [key, key, product_id]
+
+
+def order_by_clause(sort, alias='ps'):
+    column, direction = PRODUCT_SORTS[sort]
+    if sort == 'relevance':
+        return f' ORDER BY {alias}.relevance DESC, {alias}.product_id DESC'
+    if column is None:
+        return f' ORDER BY {alias}.product_id {direction}'
+    return f' ORDER BY {alias}.{sort_key_field(sort)} {direction}, {alias}.product_id {direction}'
+
+
+# --- Facets ---
+
+# (lower bound, upper bound, label); None = no upper bound
+PRICE_BANDS = [
+    (0, 25, 'Under $25'),
+    (25, 50, '$25 - $50'),
+    (50, 100, '$50 - $100'),
+    (100, 250, '$100 - $250'),
+    (250, 500, '$250 - $500'),
+    (500, 1000, '$500 - $1,000'),
+    (1000, None, '$1,000 & up'),
+]
+FACET_INDEX_MAX_AGE = 300  # seconds before a full rebuild, picks up other processes' writes
+
+
+def price_band(price):
+    for index, (_, upper, _) in enumerate(PRICE_BANDS):
+        if upper is None or price < upper:
+            return index
+
+
+def facet_filters(brands=(), price_bands=(), supplier_ids=(), in_stock=False):
+    # WHERE fragments for the selected facet values; values within one facet
+    # are OR'ed, different facets are AND'ed
+    conditions = []
+    params = []
+    if brands:
+        conditions.append(f"p.brand IN ({', '.join(['%s'] * len(brands))})")
+        params.extend(brands)
+    bands = []
+    for index in price_bands:
+        if 0 <= index < len(PRICE_BANDS):
+            lower, upper, _ = PRICE_BANDS[index]
+            if upper is None:
+                bands.append('p.price >= %s')
+                params.append(lower)
+            else:
+                bands.append('(p.price >= %s AND p.price < %s)')
+                params.extend([lower, upper])
+    if bands:
+        conditions.append('(' + ' OR '.join(bands) + ')')
+    if supplier_ids:
+        conditions.append(f'''EXISTS (
+            SELECT 1 FROM Supplier_Product sp
+            JOIN Supplier s ON sp.supplier_id = s.supplier_id
+            WHERE sp.product_id = p.product_id AND s.is_active = TRUE
+                AND sp.supplier_id IN ({', '.join(['%s'] * len(supplier_ids))})
+        )''')
+        params.extend(supplier_ids)
+    if in_stock:
+        conditions.append('p.product_id IN (SELECT product_id FROM Product_Stock WHERE available_stock > 0)')
+    return conditions, params
+
+
+class FacetIndex:
+    # Facet counts per category (None = whole catalog), kept in memory.
+    # Writers mark products dirty; the next read reloads only those products
+    # and moves their contributions between counters.
+    def __init__(self, max_age=FACET_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self._products = {}   # product_id -> (category_id, brand, band, supplier_ids, in_stock)
+        self._counts = {}     # category_id -> facet -> Counter
+        self._suppliers = {}  # supplier_id -> supplier_name
+        self._dirty = set()
+        self._stale = True
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def mark_dirty(self, product_ids=None):
+        # None means the whole index (e.g. a category or supplier changed)
+        with self._lock:
+            if product_ids is None:
+                self._stale = True
+            else:
+                self._dirty.update(product_ids)
+
+    def counts(self, cursor, category_id=None):
+        with self._lock:
+            if self._stale or time.monotonic() - self._built_at > self.max_age:
+                self._rebuild(cursor)
+            elif self._dirty:
+                self._refresh(cursor, self._dirty)
+            self._dirty = set()
+            return self._facets(category_id)
+
+    def _load(self, cursor, product_ids=None):
+        sql = '''
+            SELECT
+                p.product_id,
+                p.category_id,
+                p.brand,
+                p.price,
+                MAX(IFNULL(pstock.available_stock, 0)) > 0 AS in_stock,
+                GROUP_CONCAT(s.supplier_id) AS supplier_ids
+            FROM
+                Product p
+            LEFT JOIN
+                Product_Stock pstock ON p.product_id = pstock.product_id
+            LEFT JOIN
+                Supplier_Product sp ON p.product_id = sp.product_id
+            LEFT JOIN
+                Supplier s ON sp.supplier_id = s.supplier_id AND s.is_active = TRUE
+            WHERE
+                p.is_active = TRUE
+        '''
+        params = []
+        if product_ids is not None:
+            sql += f" AND p.product_id IN ({', '.join(['%s'] * len(product_ids))})"
+            params.extend(product_ids)
+        sql += ' GROUP BY p.product_id'
+        cursor.execute(sql, params)
+        products = {}
+        for row in cursor.fetchall():
+            supplier_ids = frozenset(int(s) for s in row['supplier_ids'].split(',')) if row['supplier_ids'] else frozenset()
+            products[row['product_id']] = (
+                row['category_id'], row['brand'], price_band(row['price']), supplier_ids, bool(row['in_stock'])
+            )
+        return products
+
+    def _apply(self, values, delta):
+        category_id, brand, band, supplier_ids, in_stock = values
+        for key in (None, category_id):
+            counts = self._counts.setdefault(key, {
+                'brand': Counter(), 'price': Counter(), 'supplier': Counter(), 'in_stock': Counter()
+            })
+            counts['brand'][brand] += delta
+            counts['price'][band] += delta
+            for supplier_id in supplier_ids:
+                counts['supplier'][supplier_id] += delta
+            if in_stock:
+                counts['in_stock'][True] += delta
+
+    def _rebuild(self, cursor):
+        cursor.execute('SELECT supplier_id, supplier_name FROM Supplier WHERE is_active = TRUE')
+        self._suppliers = {row['supplier_id']: row['supplier_name'] for row in cursor.fetchall()}
+        self._products = self._load(cursor)
+        self._counts = {}
+        for values in self._products.values():
+            self._apply(values, 1)
+        self._stale = False
+        self._built_at = time.monotonic()
+
+    def _refresh(self, cursor, product_ids):
+        product_ids = sorted(product_ids)
+        fresh = self._load(cursor, product_ids)
+        for product_id in product_ids:
+            old = self._products.pop(product_id, None)
+            if old is not None:
+                self._apply(old, -1)
+            if product_id in fresh:
+                self._products[product_id] = fresh[product_id]
+                self._apply(fresh[product_id], 1)
+
+    def _facets(self, category_id):
+        counts = self._counts.get(category_id)
+        if not counts:
+            return {'brand': [], 'price': [], 'supplier': [], 'in_stock': 0}
+        return {
+            'brand': sorted(
+                ({'value': brand, 'label': brand, 'count': n} for brand, n in counts['brand'].items() if n > 0),
+                key=lambda f: (f['label'] or '').lower()
+            ),
+            'price': [
+                {'value': index, 'label': PRICE_BANDS[index][2], 'count': counts['price'][index]}
+                for index in range(len(PRICE_BANDS)) if counts['price'][index] > 0
+            ],
+            'supplier': sorted(
+                ({'value': supplier_id, 'label': self._suppliers.get(supplier_id, ''), 'count': n}
+                 for supplier_id, n in counts['supplier'].items() if n > 0 and supplier_id in self._suppliers),
+                key=lambda f: f['label'].lower()
+            ),
+            'in_stock': counts['in_stock'][True],
+        }
+
+
+facet_index = FacetIndex()
+
+
+# --- Autocomplete ---
+
+AUTOCOMPLETE_LIMIT = 8
+MAX_AUTOCOMPLETE_LIMIT = 20
+AUTOCOMPLETE_MAX_AGE = 300  # seconds before a full rebuild, picks up other processes' writes
+
+
+class AutocompleteIndex:
+    # Sorted (key, kind, ref) entries searched with bisect. Every product is
+    # reachable from the start of its name and from each later word in it
+    # ("iph" finds "Apple iPhone 13"); brands are separate entries.
+    def __init__(self, max_age=AUTOCOMPLETE_MAX_AGE):
+        self.max_age = max_age
+        self._entries = []
+        self._products = {}       # product_id -> (product_name, brand)
+        self._brands = Counter()  # brand -> number of active products
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _product_keys(name):
+        words = (name or '').lower().split()
+        return {' '.join(words[i:]) for i in range(len(words))}
+
+    def _add(self, product_id, name, brand):
+        self._products[product_id] = (name, brand)
+        for key in self._product_keys(name):
+            insort(self._entries, (key, 'product', product_id))
+        if brand:
+            self._brands[brand] += 1
+            if self._brands[brand] == 1:
+                insort(self._entries, (brand.lower(), 'brand', brand))
+
+    def _remove(self, product_id):
+        name, brand = self._products.pop(product_id)
+        for key in self._product_keys(name):
+            self._delete((key, 'product', product_id))
+        if brand:
+            self._brands[brand] -= 1
+            if self._brands[brand] <= 0:
+                del self._brands[brand]
+                self._delete((brand.lower(), 'brand', brand))
+
+    def _delete(self, entry):
+        index = bisect_left(self._entries, entry)
+        if index < len(self._entries) and self._entries[index] == entry:
+            del self._entries[index]
+
+    def _load(self, cursor, product_ids=None):
+        sql = 'SELECT product_id, product_name, brand FROM Product WHERE is_active = TRUE'
+        params = []
+        if product_ids is not None:
+            sql += f" AND product_id IN ({', '.join(['%s'] * len(product_ids))})"
+            params.extend(product_ids)
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def rebuild(self, cursor):
+        rows = self._load(cursor)
+        with self._lock:
+            self._entries = []
+            self._products = {}
+            self._brands = Counter()
+            for row in rows:
+                self._add(row['product_id'], row['product_name'], row['brand'])
+            self._built_at = time.monotonic()
+
+    def claim_rebuild(self):
+        # True for the one caller that should rebuild an index past max_age;
+        # others keep serving the current entries meanwhile
+        with self._lock:
+            now = time.monotonic()
+            if now - self._built_at <= self.max_age:
+                return False
+            self._built_at = now
+            return True
+
+    def refresh(self, cursor, product_ids):
+        product_ids = sorted(set(product_ids))
+        if not product_ids:
+            return
+        rows = self._load(cursor, product_ids)
+        with self._lock:
+            for product_id in product_ids:
+                if product_id in self._products:
+                    self._remove(product_id)
+            for row in rows:
+                self._add(row['product_id'], row['product_name'], row['brand'])
+
+    def suggest(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix:
+            return []
+        suggestions = []
+        seen = set()
+        with self._lock:
+            index = bisect_left(self._entries, (prefix,))
+            while index < len(self._entries) and len(suggestions) < limit:
+                key, kind, ref = self._entries[index]
+                if not key.startswith(prefix):
+                    break
+                index += 1
+                if (kind, ref) in seen:
+                    continue
+                seen.add((kind, ref))
+                if kind == 'brand':
+                    suggestions.append({'type': 'brand', 'label': ref})
+                else:
+                    name, brand = self._products[ref]
+                    suggestions.append({'type': 'product', 'label': name, 'brand': brand, 'product_id': ref})
+        return suggestions
+
+
+autocomplete_index = AutocompleteIndex()
+
+
+def rebuild_autocomplete_index():
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            autocomplete_index.rebuild(cursor)
+    finally:
+        conn.close()
+
+
+def suggest_products(prefix, limit=AUTOCOMPLETE_LIMIT):
+    # Writes in other worker processes only reach this index via a rebuild.
+    # It runs in a background thread on its own connection; this request and
+    # the ones after it keep answering from the current entries.
+    if autocomplete_index.claim_rebuild():
+        threading.Thread(target=rebuild_autocomplete_index, name='autocomplete-rebuild', daemon=True).start()
+    return autocomplete_index.suggest(prefix, limit)
+
+
+def init_app(app):
+    # Build the autocomplete index from the active products at startup
+    rebuild_autocomplete_index()
+
+
+# --- Product cache ---
+
+PRODUCT_CACHE_SIZE = 2048
+PRODUCT_CACHE_MAX_AGE = 60  # seconds, bounds staleness after writes by other processes
+
+
+class ProductCache:
+    # Product rows (with category_name) by product_id. Each entry remembers the
+    # catalog version it was loaded under; bumping the version retires them all.
+    def __init__(self, max_size=PRODUCT_CACHE_SIZE, max_age=PRODUCT_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self.version = 0
+        self._rows = LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def bump_version(self):
+        with self._lock:
+            self.version += 1
+            self._rows.clear()
+
+    def get(self, product_id):
+        return self.get_many([product_id]).get(product_id)
+
+    def get_many(self, product_ids):
+        # {product_id: row} for the ids that exist; only cache misses hit MySQL
+        now = time.monotonic()
+        version = self.version
+        found = {}
+        misses = []
+        for product_id in set(product_ids):
+            entry = self._rows.get(product_id)
+            if entry and entry[0] == version and now - entry[1] <= self.max_age:
+                found[product_id] = dict(entry[2])
+            else:
+                misses.append(product_id)
+        if misses:
+            conn = get_db_connection()
+            with conn.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT p.*, c.category_name
+                    FROM Product p
+                    JOIN Category c ON p.category_id = c.category_id
+                    WHERE p.product_id IN ({', '.join(['%s'] * len(misses))})
+                """, misses)
+                rows = cursor.fetchall()
+            conn.close()
+            for row in rows:
+                # Stored under the version read before the query, so a bump
+                # that races with this load still retires the row
+                self._rows.set(row['product_id'], (version, now, row))
+                found[row['product_id']] = dict(row)
+        return found
+
+
+product_cache = ProductCache()
+
+
+# --- Product page ---
+
+PRODUCT_VIEW_CACHE_SIZE = 1024
+PRODUCT_VIEW_MAX_AGE = 60
+
+PRODUCT_VIEW_QUERY = '''
+    SELECT
+        p.*,
+        c.category_name,
+        IFNULL(pstock.available_stock, 0) AS stock_quantity,
+        (
+            SELECT JSON_ARRAYAGG(JSON_OBJECT('supplier_id', s.supplier_id, 'supplier_name', s.supplier_name))
+            FROM Supplier_Product sp
+            JOIN Supplier s ON sp.supplier_id = s.supplier_id
+            WHERE sp.product_id = p.product_id AND s.is_active = TRUE
+        ) AS suppliers
+    FROM
+        Product p
+    JOIN
+        Category c ON p.category_id = c.category_id
+    LEFT JOIN
+        Product_Stock pstock ON p.product_id = pstock.product_id
+    WHERE
+        p.product_id = %s AND p.is_active = TRUE
+'''
+
+# product_id -> (loaded_at, catalog version, view); dropped by the product and
+# stock hooks, and ignored once Catalog_State moves past its version (a write
+# in another worker process)
+product_view_cache = LRUCache(PRODUCT_VIEW_CACHE_SIZE)
+
+
+def load_product_view(product_id):
+    # Product, category, stock total and suppliers in one statement
+    conn = get_db_connection()
+    with conn.cursor() as cursor:
+        cursor.execute(PRODUCT_VIEW_QUERY, (product_id,))
+        product = cursor.fetchone()
+    conn.close()
+    if not product:
+        return None
+    suppliers = json.loads(product.pop('suppliers')) if product['suppliers'] else []
+    suppliers.sort(key=lambda s: s['supplier_name'])
+    return {
+        'product': product,
+        'stock_quantity': product.pop('stock_quantity'),
+        'suppliers': suppliers,
+    }
+
+
+def get_product_view(product_id, version=None):
+    # version is the current Catalog_State version, when the caller has it
+    entry = product_view_cache.get(product_id)
+    if entry:
+        loaded_at, loaded_version, view = entry
+        if time.monotonic() - loaded_at <= PRODUCT_VIEW_MAX_AGE and (version is None or version == loaded_version):
+            return view
+    loaded_at = time.monotonic()
+    view = load_product_view(product_id)
+    if view is not None:
+        product_view_cache.set(product_id, (loaded_at, version, view))
+    return view
+
+
+def forget_product_views(product_ids=None):
+    if product_ids is None:
+        product_view_cache.clear()
+    else:
+        for product_id in product_ids:
+            product_view_cache.pop(product_id)
+
+
+# --- Categories ---
+
+def get_categories(active_only=False):
+    # Every category (or only active ones), shared by all pages for 5 minutes
+    def load():
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            if active_only:
+                cursor.execute('SELECT * FROM Category WHERE is_active = TRUE')
+            else:
+                cursor.execute('SELECT * FROM Category')
+            categories = cursor.fetchall()
+        conn.close()
+        return categories
+    return category_cache.get_or_set('active' if active_only else 'all', load)
+
+
+# --- Catalog version ---
+# One Catalog_State row, bumped after every catalog or stock write. Its
+# version and timestamp drive ETag / Last-Modified on the catalog pages and
+# are shared by all worker processes.
+
+def get_catalog_state():
+    conn = get_db_connection()
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT version, updated_at FROM Catalog_State WHERE state_id = 1')
+        state = cursor.fetchone()
+    conn.close()
+    return state
+
+
+def bump_catalog_version():
+    conn = get_db_connection()
+    with conn.cursor() as cursor:
+        cursor.execute('UPDATE Catalog_State SET version = version + 1, updated_at = UTC_TIMESTAMP() WHERE state_id = 1')
+    conn.commit()
+    conn.close()
+
+
+# --- Change hooks ---
+# Call after committing a catalog write so in-process indexes catch up.
+# product_ids=None means "possibly every product".
+
+def product_changed(product_ids=None):
+    bump_catalog_version()
+    product_cache.bump_version()
+    forget_product_views(product_ids)
+    facet_index.mark_dirty(product_ids)
+    conn = get_db_connection()
+    with conn.cursor() as cursor:
+        if product_ids is None:
+            autocomplete_index.rebuild(cursor)
+        else:
+            autocomplete_index.refresh(cursor, product_ids)
+    conn.close()
+
+
+def stock_changed(product_ids=None):
+    bump_catalog_version()
+    forget_product_views(product_ids)
+    facet_index.mark_dirty(product_ids)
+
+
+def category_changed():
+    invalidate_category_cache()
+    # Cached featured rows and the category sales widget carry category names
+    invalidate_dashboard_cache()
+    admin_widget_cache.invalidate('category_sales')
+    product_changed()
@@ -0,0 +1,93 @@
+import click
+
+from app.db import borrow_connection
+from app.stats import rebuild_product_stats, rebuild_daily_rollups
+from app.inventory import reconcile_stock_ledger, check_product_stock, rebuild_product_stock
+
+
+def register_commands(app):
+    app.cli.add_command(rebuild_product_stats_command)
+    app.cli.add_command(reconcile_stock_ledger_command)
+    app.cli.add_command(rebuild_daily_rollups_command)
+    app.cli.add_command(check_product_stock_command)
+    app.cli.add_command(purge_anonymous_carts_command)
+
+
+@click.command('rebuild-product-stats')
+def rebuild_product_stats_command():
+    """Rebuild Product_Stats (per-product order counters) from Order_Line."""
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            rebuild_product_stats(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo('Product_Stats rebuilt.')
+
+
+@click.command('reconcile-stock-ledger')
+def reconcile_stock_ledger_command():
+    """Seed or correct Stock_Movement so it adds up to Warehouse_Stock."""
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            adjusted = reconcile_stock_ledger(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f'Stock ledger reconciled ({adjusted} adjustment rows written).')
+
+
+@click.command('rebuild-daily-rollups')
+def rebuild_daily_rollups_command():
+    """Rebuild Daily_Rollup (orders, items, sales, registrations per day) from history."""
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            rebuild_daily_rollups(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo('Daily_Rollup rebuilt.')
+
+
+@click.command('check-product-stock')
+@click.option('--repair', is_flag=True, help='Rebuild Product_Stock from Warehouse_Stock.')
+def check_product_stock_command(repair):
+    """Compare Product_Stock totals with Warehouse_Stock, optionally rebuilding them."""
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            mismatches = check_product_stock(cursor)
+            for row in mismatches:
+                click.echo(f"Product {row['product_id']}: stored {row['available_stock']}, actual {row['actual']}")
+            if repair:
+                rebuild_product_stock(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+    if not mismatches:
+        click.echo('Product_Stock is consistent.')
+    elif repair:
+        click.echo(f'Product_Stock rebuilt ({len(mismatches)} products corrected).')
+    else:
+        click.echo(f'{len(mismatches)} products out of sync; run with --repair to rebuild.')
+
+
+@click.command('purge-anonymous-carts')
+@click.option('--days', default=30, show_default=True, help='Age of the last change after which a cart is dropped.')
+def purge_anonymous_carts_command(days):
+    """Delete carts of visitors who never logged in and stopped changing them."""
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                DELETE FROM Cart_Item
+                WHERE cart_key LIKE 'session:%%' AND updated_at < NOW() - INTERVAL %s DAY
+            ''', (days,))
+            purged = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f'Removed {purged} cart lines.')
@@ -1,11 +1,421 @@
-import pymysql
-
-def get_db_connection():
-    return pymysql.connect(
-        host='localhost',
-        user='root',         
-        password='1222936',         
-        database='CobraShopOnlineStore',
-        charset='utf8mb4',
-        cursorclass=pymysql.cursors.DictCursor
-    ) 
\ No newline at end of file
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+from flask import g, has_request_context
+
+from app.inventory import LEDGER_OPENING_DATE, MOVEMENT_ADJUSTMENT, PRODUCT_STOCK_ACTUAL
+from app.stats import DAILY_ROLLUP_HISTORY, PENDING_COD_HISTORY
+
+DB_SETTINGS = dict(
+    host='localhost',
+    user='root',
+    password='1222936',
+    database='CobraShopOnlineStore',
+    charset='utf8mb4',
+    cursorclass=pymysql.cursors.DictCursor
+)
+
+# Pool defaults, can be overridden through app.config (see init_app)
+POOL_DEFAULTS = {
+    'DB_POOL_MIN_SIZE': 2,
+    'DB_POOL_MAX_SIZE': 10,
+    'DB_POOL_MAX_LIFETIME': 1800,   # seconds before a connection is recycled
+    'DB_POOL_ACQUIRE_TIMEOUT': 10,  # seconds to wait for a free connection
+    'DB_FAN_OUT_WORKERS': 4,        # concurrent read queries per fan_out() call
+}
+
+
+# Derived tables maintained by the application, created (and seeded) on startup if missing
+SCHEMA_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS Product_Stats (
+        product_id INT NOT NULL PRIMARY KEY,
+        order_count INT NOT NULL DEFAULT 0,
+        units_ordered INT NOT NULL DEFAULT 0,
+        INDEX idx_product_stats_order_count (order_count)
+    )
+    ''',
+    # Counters for orders placed before the table existed
+    '''
+    INSERT INTO Product_Stats (product_id, order_count, units_ordered)
+    SELECT product_id, COUNT(*), IFNULL(SUM(quantity), 0)
+    FROM Order_Line
+    WHERE NOT EXISTS (SELECT 1 FROM Product_Stats)
+    GROUP BY product_id
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Stock_Movement (
+        movement_id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        warehouse_id INT NOT NULL,
+        product_id INT NOT NULL,
+        quantity_change INT NOT NULL,
+        reason VARCHAR(20) NOT NULL,
+        order_id INT NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_stock_movement_created (created_at),
+        INDEX idx_stock_movement_product (product_id, created_at)
+    )
+    ''',
+    # Opening balances for an empty ledger, dated before any chart window
+    f'''
+    INSERT INTO Stock_Movement (warehouse_id, product_id, quantity_change, reason, created_at)
+    SELECT warehouse_id, product_id, stock_quantity, '{MOVEMENT_ADJUSTMENT}', '{LEDGER_OPENING_DATE}'
+    FROM Warehouse_Stock
+    WHERE stock_quantity <> 0 AND NOT EXISTS (SELECT 1 FROM Stock_Movement)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Daily_Rollup (
+        rollup_date DATE NOT NULL PRIMARY KEY,
+        orders INT NOT NULL DEFAULT 0,
+        items INT NOT NULL DEFAULT 0,
+        gross_sales DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        cod_pending_sales DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        registrations INT NOT NULL DEFAULT 0
+    )
+    ''',
+    f'''
+    INSERT INTO Daily_Rollup (rollup_date, orders, items, gross_sales, cod_pending_sales, registrations)
+    SELECT * FROM ({DAILY_ROLLUP_HISTORY}) h
+    WHERE NOT EXISTS (SELECT 1 FROM Daily_Rollup)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Pending_Cod_Order (
+        order_id INT NOT NULL PRIMARY KEY,
+        rollup_date DATE NOT NULL,
+        amount DECIMAL(14, 2) NOT NULL
+    )
+    ''',
+    f'''
+    INSERT INTO Pending_Cod_Order (order_id, rollup_date, amount)
+    SELECT * FROM ({PENDING_COD_HISTORY}) h
+    WHERE NOT EXISTS (SELECT 1 FROM Pending_Cod_Order)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Product_Stock (
+        product_id INT NOT NULL PRIMARY KEY,
+        available_stock INT NOT NULL DEFAULT 0,
+        INDEX idx_product_stock_available (available_stock)
+    )
+    ''',
+    # Seed the totals from Warehouse_Stock the first time
+    f'''
+    INSERT INTO Product_Stock (product_id, available_stock)
+    SELECT a.product_id, a.actual
+    FROM ({PRODUCT_STOCK_ACTUAL}) a
+    WHERE NOT EXISTS (SELECT 1 FROM Product_Stock)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Catalog_State (
+        state_id TINYINT NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 1,
+        updated_at DATETIME NOT NULL
+    )
+    ''',
+    "INSERT IGNORE INTO Catalog_State (state_id, version, updated_at) VALUES (1, 1, UTC_TIMESTAMP())",
+    '''
+    CREATE TABLE IF NOT EXISTS Cart_Item (
+        cart_key VARCHAR(64) NOT NULL,
+        product_id INT NOT NULL,
+        quantity INT NOT NULL,
+        updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (cart_key, product_id),
+        INDEX idx_cart_item_updated (updated_at)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS Order_Line_Allocation (
+        order_id INT NOT NULL,
+        product_id INT NOT NULL,
+        warehouse_id INT NOT NULL,
+        quantity INT NOT NULL,
+        PRIMARY KEY (order_id, product_id, warehouse_id),
+        INDEX idx_allocation_warehouse (warehouse_id)
+    )
+    ''',
+]
+
+
+# Indexes on existing tables: (table, index name, ALTER statement)
+SCHEMA_INDEXES = [
+    ('Product', 'ft_product_search',
+     'ALTER TABLE Product ADD FULLTEXT INDEX ft_product_search (product_name, brand, product_description)'),
+]
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PooledConnection:
+    # Thin wrapper around a pymysql connection; close() hands it back to the pool
+    def __init__(self, pool, conn, created_at):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise pymysql.err.InterfaceError(0, 'Connection already returned to the pool')
+        return getattr(conn, name)
+
+    def close(self):
+        self.release()
+
+    def release(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn, self._created_at)
+
+    def __del__(self):
+        # Safety net for code paths that forget to close the connection
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class RequestConnection(PooledConnection):
+    # Shared by every get_db_connection() call in one request. Route code may
+    # call close() as often as it likes; the teardown hook releases it.
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    def __init__(self, min_size=2, max_size=10, max_lifetime=1800, acquire_timeout=10, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.max_lifetime = max_lifetime
+        self.acquire_timeout = acquire_timeout
+        self.connect_kwargs = connect_kwargs
+        self._idle = deque()  # (conn, created_at), most recently used on the right
+        self._size = 0        # idle + borrowed connections
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        return pymysql.connect(**self.connect_kwargs), time.monotonic()
+
+    def _expired(self, created_at):
+        return self.max_lifetime and time.monotonic() - created_at > self.max_lifetime
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def fill(self):
+        # Open connections until min_size is reached
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn, created_at = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, created_at))
+                self._cond.notify()
+
+    def acquire(self, timeout=None, wrapper=PooledConnection):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, created_at = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(f'Timed out after {timeout}s waiting for a database connection')
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn, created_at = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                return wrapper(self, conn, created_at)
+
+            # Health check on borrow: recycle old connections and drop dead ones
+            if self._expired(created_at):
+                self._discard(conn)
+                continue
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                self._discard(conn)
+                continue
+            return wrapper(self, conn, created_at)
+
+    def release(self, conn, created_at):
+        if not conn.open or self._expired(created_at):
+            self._discard(conn)
+            return
+        try:
+            # Never hand out a connection with a half-finished transaction
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created_at))
+            self._cond.notify()
+
+    def free_connections(self):
+        # Idle connections plus the ones that may still be opened
+        with self._cond:
+            return len(self._idle) + self.max_size - self._size
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_config = dict(POOL_DEFAULTS)
+_fan_out_executor = None
+
+
+def init_app(app):
+    for key, value in POOL_DEFAULTS.items():
+        app.config.setdefault(key, value)
+        _pool_config[key] = app.config[key]
+    app.teardown_appcontext(close_request_connection)
+    ensure_schema()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    min_size=_pool_config['DB_POOL_MIN_SIZE'],
+                    max_size=_pool_config['DB_POOL_MAX_SIZE'],
+                    max_lifetime=_pool_config['DB_POOL_MAX_LIFETIME'],
+                    acquire_timeout=_pool_config['DB_POOL_ACQUIRE_TIMEOUT'],
+                    **DB_SETTINGS
+                )
+                pool.fill()
+                _pool = pool
+    return _pool
+
+
+def borrow_connection():
+    # A pooled connection of its own, never shared with the current request
+    return get_pool().acquire()
+
+
+def get_db_connection():
+    if not has_request_context():
+        return borrow_connection()
+    # First call in a request borrows a connection, later calls reuse it
+    conn = g.get('db_conn')
+    if conn is None:
+        conn = get_pool().acquire(wrapper=RequestConnection)
+        g.db_conn = conn
+    return conn
+
+
+def close_request_connection(exc=None):
+    # Teardown hook: return the request's connection. Routes commit their own
+    # work; anything left uncommitted is rolled back by the pool on release.
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.release()
+
+
+def _run_read_queries(conn, queries):
+    # queries: [(name, (sql, params)), ...]; returns {name: rows}
+    results = {}
+    with conn.cursor() as cursor:
+        for name, (sql, params) in queries:
+            cursor.execute(sql, params)
+            results[name] = cursor.fetchall()
+    return results
+
+
+def _run_read_queries_borrowed(queries):
+    conn = borrow_connection()
+    try:
+        return _run_read_queries(conn, queries)
+    finally:
+        conn.close()
+
+
+def fan_out(queries):
+    # Run independent read queries concurrently on a few pooled connections.
+    # queries maps a name to (sql, params); returns name -> rows. Only
+    # connections the pool has free are used; when it is short the queries
+    # run one after another on the caller's own connection instead.
+    global _fan_out_executor
+    items = list(queries.items())
+    workers = min(_pool_config['DB_FAN_OUT_WORKERS'], len(items), get_pool().free_connections())
+    if workers < 2:
+        conn = get_db_connection()
+        try:
+            return _run_read_queries(conn, items)
+        finally:
+            conn.close()
+    if _fan_out_executor is None:
+        with _pool_lock:
+            if _fan_out_executor is None:
+                _fan_out_executor = ThreadPoolExecutor(
+                    max_workers=_pool_config['DB_FAN_OUT_WORKERS'],
+                    thread_name_prefix='db-fan-out'
+                )
+    # One connection per worker, each running its share of the queries in turn
+    futures = [
+        _fan_out_executor.submit(_run_read_queries_borrowed, items[index::workers])
+        for index in range(workers)
+    ]
+    results = {}
+    for future in futures:
+        results.update(future.result())
+    return {name: results[name] for name in queries}
+
+
+def ensure_schema():
+    conn = borrow_connection()
+    try:
+        with conn.cursor() as cursor:
+            for statement in SCHEMA_STATEMENTS:
+                cursor.execute(statement)
+            for table, index_name, statement in SCHEMA_INDEXES:
+                cursor.execute('''
+                    SELECT COUNT(*) AS count
+                    FROM information_schema.statistics
+                    WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+                ''', (table, index_name))
+                if not cursor.fetchone()['count']:
+                    cursor.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,341 @@
+import math
+
+# Reasons recorded on Stock_Movement rows
+MOVEMENT_ORDER = 'order'
+MOVEMENT_RESTOCK = 'restock'
+MOVEMENT_ADJUSTMENT = 'adjustment'
+MOVEMENT_REMOVAL = 'removal'
+# Opening balances and reconciliation corrections are dated here, before any
+# chart window, so they never show up as a month's stock movement
+LEDGER_OPENING_DATE = '2000-01-01'
+
+
+def record_stock_movement(cursor, warehouse_id, product_id, quantity_change, reason, order_id=None):
+    # Append one row to the stock ledger and move the product's stock total;
+    # call in the same transaction as the Warehouse_Stock write
+    if not quantity_change:
+        return
+    cursor.execute('''
+        INSERT INTO Stock_Movement (warehouse_id, product_id, quantity_change, reason, order_id)
+        VALUES (%s, %s, %s, %s, %s)
+    ''', (warehouse_id, product_id, quantity_change, reason, order_id))
+    adjust_product_stock(cursor, warehouse_id, product_id, quantity_change)
+
+
+# --- Product stock totals ---
+# Product_Stock holds SUM(stock_quantity) over active warehouses for each
+# product, so stock reads are a primary-key lookup.
+
+def adjust_product_stock(cursor, warehouse_id, product_id, quantity_change):
+    # Archived warehouses do not count towards available stock
+    cursor.execute('''
+        INSERT INTO Product_Stock (product_id, available_stock)
+        SELECT %s, %s
+        FROM Warehouse
+        WHERE warehouse_id = %s AND is_active = TRUE
+        ON DUPLICATE KEY UPDATE
+            available_stock = available_stock + VALUES(available_stock)
+    ''', (product_id, quantity_change, warehouse_id))
+
+
+def set_warehouse_stock_active(cursor, warehouse_id, active):
+    # A warehouse was archived or restored: remove or add back its stock.
+    # Call after updating Warehouse.is_active, in the same transaction.
+    sign = 1 if active else -1
+    cursor.execute('''
+        INSERT INTO Product_Stock (product_id, available_stock)
+        SELECT product_id, %s * SUM(stock_quantity)
+        FROM Warehouse_Stock
+        WHERE warehouse_id = %s
+        GROUP BY product_id
+        ON DUPLICATE KEY UPDATE
+            available_stock = available_stock + VALUES(available_stock)
+    ''', (sign, warehouse_id))
+
+
+def get_product_stock(cursor, product_id, for_update=False):
+    sql = 'SELECT available_stock FROM Product_Stock WHERE product_id = %s'
+    if for_update:
+        sql += ' FOR UPDATE'
+    cursor.execute(sql, (product_id,))
+    row = cursor.fetchone()
+    return row['available_stock'] if row else 0
+
+
+def lock_available_stock(cursor, quantities):
+    # Lock the stock totals of every ordered product in one statement, in
+    # product_id order so concurrent checkouts take locks in the same order.
+    # Only Product_Stock is locked; anything else that changes stock must
+    # lock these rows first too (see get_product_stock(for_update=True)).
+    # quantities: {product_id: quantity}. Returns the shortages as
+    # [(product_id, needed, available)]; empty when everything is in stock.
+    product_ids = sorted(quantities)
+    cursor.execute(f'''
+        SELECT ps.product_id, ps.available_stock
+        FROM Product_Stock ps
+        JOIN Product p ON ps.product_id = p.product_id
+        WHERE ps.product_id IN ({', '.join(['%s'] * len(product_ids))}) AND p.is_active = TRUE
+        ORDER BY ps.product_id
+        FOR UPDATE OF ps
+    ''', product_ids)
+    available = {row['product_id']: row['available_stock'] for row in cursor.fetchall()}
+    return [
+        (product_id, quantities[product_id], available.get(product_id, 0))
+        for product_id in product_ids
+        if available.get(product_id, 0) < quantities[product_id]
+    ]
+
+
+# --- Order allocation ---
+
+class AllocationError(Exception):
+    pass
+
+
+def lock_warehouse_stock(cursor, product_ids):
+    # Every active-warehouse stock row for the ordered products, locked in
+    # one statement (primary key order keeps concurrent checkouts consistent)
+    product_ids = sorted(product_ids)
+    cursor.execute(f'''
+        SELECT ws.warehouse_id, ws.product_id, ws.stock_quantity, w.city
+        FROM Warehouse_Stock ws
+        JOIN Warehouse w ON ws.warehouse_id = w.warehouse_id
+        WHERE ws.product_id IN ({', '.join(['%s'] * len(product_ids))})
+            AND ws.stock_quantity > 0 AND w.is_active = TRUE
+        ORDER BY ws.warehouse_id, ws.product_id
+        FOR UPDATE OF ws
+    ''', product_ids)
+    return cursor.fetchall()
+
+
+# Approximate city centres (latitude, longitude) for the cities we ship to;
+# the keys match ALLOWED_CITIES and Warehouse.city
+CITY_COORDINATES = {
+    'Ramallah': (31.9038, 35.2034),
+    'Nablus': (32.2211, 35.2544),
+    'Hebron (Al-Khalil)': (31.5326, 35.0998),
+    'Bethlehem (Beit Lahm)': (31.7054, 35.2024),
+    'Jericho (Ariha)': (31.8667, 35.4500),
+    'Jenin': (32.4610, 35.3009),
+    'Tulkarm': (32.3104, 35.0286),
+    'Qalqilya': (32.1897, 34.9706),
+    'East Jerusalem (Al-Quds)': (31.7833, 35.2333),
+}
+
+
+def _great_circle_km(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(h))
+
+
+# City-to-city distances in km, computed once at import
+CITY_DISTANCES = {
+    origin: {destination: round(_great_circle_km(a, b), 1) for destination, b in CITY_COORDINATES.items()}
+    for origin, a in CITY_COORDINATES.items()
+}
+UNKNOWN_CITY_DISTANCE = 1000.0  # ranks warehouses in unlisted cities last
+
+
+def city_distance(origin, destination):
+    return CITY_DISTANCES.get(origin, {}).get(destination, UNKNOWN_CITY_DISTANCE)
+
+
+def plan_allocation(stock_rows, quantities, destination_city=None):
+    # Fulfilment plan that ships from as few warehouses as possible, nearest
+    # to the destination first. Greedy set cover: while units remain, use the
+    # nearest warehouse that can ship everything still missing; otherwise the
+    # warehouse covering the most missing units (ties: nearest, then id).
+    # Returns [(warehouse_id, product_id, quantity)].
+    stock = {}
+    distance = {}
+    for row in stock_rows:
+        stock.setdefault(row['warehouse_id'], {})[row['product_id']] = row['stock_quantity']
+        distance[row['warehouse_id']] = city_distance(row['city'], destination_city)
+    remaining = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+
+    plan = []
+    while remaining:
+        best = None
+        for warehouse_id, available in stock.items():
+            covered = sum(min(available.get(product_id, 0), quantity) for product_id, quantity in remaining.items())
+            if not covered:
+                continue
+            complete = all(available.get(product_id, 0) >= quantity for product_id, quantity in remaining.items())
+            key = (not complete, -covered if not complete else 0, distance[warehouse_id], warehouse_id)
+            if best is None or key < best[0]:
+                best = (key, warehouse_id)
+        if best is None:
+            product_id = min(remaining)
+            raise AllocationError(f'Not enough warehouse stock for product {product_id}.')
+
+        warehouse_id = best[1]
+        available = stock.pop(warehouse_id)
+        for product_id in sorted(remaining):
+            take = min(available.get(product_id, 0), remaining[product_id])
+            if take:
+                plan.append((warehouse_id, product_id, take))
+                remaining[product_id] -= take
+                if not remaining[product_id]:
+                    del remaining[product_id]
+    return plan
+
+
+def apply_allocation(cursor, order_id, plan):
+    # Deduct the whole plan with one UPDATE, then write the ledger, the
+    # product totals and the per-line allocations as batched inserts.
+    # Every warehouse in the plan is active (see lock_warehouse_stock).
+    if not plan:
+        return
+    derived = ' UNION ALL '.join(['SELECT %s AS warehouse_id, %s AS product_id, %s AS quantity'] * len(plan))
+    cursor.execute(f'''
+        UPDATE Warehouse_Stock ws
+        JOIN ({derived}) a ON ws.warehouse_id = a.warehouse_id AND ws.product_id = a.product_id
+        SET ws.stock_quantity = ws.stock_quantity - a.quantity
+    ''', [value for allocation in plan for value in allocation])
+
+    cursor.executemany('''
+        INSERT INTO Stock_Movement (warehouse_id, product_id, quantity_change, reason, order_id)
+        VALUES (%s, %s, %s, %s, %s)
+    ''', [(warehouse_id, product_id, -quantity, MOVEMENT_ORDER, order_id) for warehouse_id, product_id, quantity in plan])
+
+    totals = {}
+    for _, product_id, quantity in plan:
+        totals[product_id] = totals.get(product_id, 0) + quantity
+    cursor.executemany('''
+        INSERT INTO Product_Stock (product_id, available_stock)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE
+            available_stock = available_stock + VALUES(available_stock)
+    ''', [(product_id, -quantity) for product_id, quantity in totals.items()])
+
+    cursor.executemany('''
+        INSERT INTO Order_Line_Allocation (order_id, product_id, warehouse_id, quantity)
+        VALUES (%s, %s, %s, %s)
+    ''', [(order_id, product_id, warehouse_id, quantity) for warehouse_id, product_id, quantity in plan])
+
+
+PRODUCT_STOCK_ACTUAL = '''
+    SELECT ws.product_id, SUM(ws.stock_quantity) AS actual
+    FROM Warehouse_Stock ws
+    JOIN Warehouse w ON ws.warehouse_id = w.warehouse_id
+    WHERE w.is_active = TRUE
+    GROUP BY ws.product_id
+'''
+
+
+def check_product_stock(cursor):
+    # Products whose maintained total differs from Warehouse_Stock
+    cursor.execute(f'''
+        SELECT product_id, available_stock, actual
+        FROM (
+            SELECT ps.product_id, ps.available_stock, IFNULL(a.actual, 0) AS actual
+            FROM Product_Stock ps
+            LEFT JOIN ({PRODUCT_STOCK_ACTUAL}) a ON a.product_id = ps.product_id
+            UNION ALL
+            SELECT a.product_id, 0, a.actual
+            FROM ({PRODUCT_STOCK_ACTUAL}) a
+            LEFT JOIN Product_Stock ps ON ps.product_id = a.product_id
+            WHERE ps.product_id IS NULL
+        ) totals
+        WHERE available_stock <> actual
+        ORDER BY product_id
+    ''')
+    return cursor.fetchall()
+
+
+def rebuild_product_stock(cursor):
+    cursor.execute('DELETE FROM Product_Stock')
+    cursor.execute(f'''
+        INSERT INTO Product_Stock (product_id, available_stock)
+        SELECT product_id, actual FROM ({PRODUCT_STOCK_ACTUAL}) a
+    ''')
+
+
+def stock_levels_by_month(cursor, month_starts, window_end):
+    # Total active stock at the end of each month: start from today's total
+    # and walk back through the ledger rows inside the chart window only
+    cursor.execute('''
+        SELECT
+            IFNULL(SUM(ws.stock_quantity), 0) AS total
+        FROM
+            Warehouse_Stock ws
+        JOIN
+            Product p ON ws.product_id = p.product_id
+        JOIN
+            Warehouse w ON ws.warehouse_id = w.warehouse_id
+        WHERE
+            p.is_active = TRUE AND w.is_active = TRUE
+    ''')
+    current_stock = int(cursor.fetchone()['total'])
+
+    cursor.execute('''
+        SELECT
+            DATE_FORMAT(sm.created_at, '%%Y-%%m') AS month_key,
+            SUM(sm.quantity_change) AS quantity_change
+        FROM
+            Stock_Movement sm
+        JOIN
+            Product p ON sm.product_id = p.product_id
+        JOIN
+            Warehouse w ON sm.warehouse_id = w.warehouse_id
+        WHERE
+            sm.created_at >= %s AND p.is_active = TRUE AND w.is_active = TRUE
+        GROUP BY
+            month_key
+    ''', (month_starts[0],))
+    changes = {row['month_key']: int(row['quantity_change'] or 0) for row in cursor.fetchall()}
+
+    # Movements after the window (normally none) are undone first
+    window_keys = {month_start.strftime('%Y-%m') for month_start in month_starts}
+    running_stock = current_stock - sum(change for key, change in changes.items() if key not in window_keys)
+    levels = []
+    for month_start in reversed(month_starts):
+        levels.append(running_stock)
+        running_stock -= changes.get(month_start.strftime('%Y-%m'), 0)
+    levels.reverse()
+    return levels
+
+
+def reconcile_stock_ledger(cursor):
+    # Add adjustment rows so the ledger total of every (warehouse, product)
+    # matches Warehouse_Stock; seeds opening balances on first run
+    cursor.execute('''
+        INSERT INTO Stock_Movement (warehouse_id, product_id, quantity_change, reason, created_at)
+        SELECT
+            ws.warehouse_id,
+            ws.product_id,
+            ws.stock_quantity - IFNULL(m.total, 0),
+            %s,
+            %s
+        FROM
+            Warehouse_Stock ws
+        LEFT JOIN (
+            SELECT warehouse_id, product_id, SUM(quantity_change) AS total
+            FROM Stock_Movement
+            GROUP BY warehouse_id, product_id
+        ) m ON m.warehouse_id = ws.warehouse_id AND m.product_id = ws.product_id
+        WHERE
+            ws.stock_quantity <> IFNULL(m.total, 0)
+    ''', (MOVEMENT_ADJUSTMENT, LEDGER_OPENING_DATE))
+    adjusted = cursor.rowcount
+    # Rows that were deleted from Warehouse_Stock without a ledger entry
+    cursor.execute('''
+        INSERT INTO Stock_Movement (warehouse_id, product_id, quantity_change, reason, created_at)
+        SELECT
+            m.warehouse_id,
+            m.product_id,
+            -m.total,
+            %s,
+            %s
+        FROM (
+            SELECT warehouse_id, product_id, SUM(quantity_change) AS total
+            FROM Stock_Movement
+            GROUP BY warehouse_id, product_id
+        ) m
+        LEFT JOIN
+            Warehouse_Stock ws ON m.warehouse_id = ws.warehouse_id AND m.product_id = ws.product_id
+        WHERE
+            ws.product_id IS NULL AND m.total <> 0
+    ''', (MOVEMENT_ADJUSTMENT, LEDGER_OPENING_DATE))
+    return adjusted + cursor.rowcount
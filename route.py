@@ -1,10 +1,23 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
-from app.db import get_db_connection
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app, jsonify, make_response, g
+from app.db import get_db_connection, fan_out
+from app.cache import dashboard_cache, invalidate_dashboard_cache, admin_widget_cache
+from app.stats import monthly_chart_data, get_featured_products, record_product_orders, last_n_months, next_month, month_key, profit_tier_query, summarize_profit
+from app.stats import record_order_rollup, record_registration_rollup, settle_cod_rollup
+from app.catalog import product_search, PRODUCT_SORTS, PRODUCTS_PER_PAGE, MAX_PRODUCTS_PER_PAGE
+from app.catalog import encode_cursor, decode_cursor, keyset_condition, order_by_clause
+from app.catalog import facet_filters, facet_index, product_changed, stock_changed
+from app.catalog import suggest_products, AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT, product_cache
+from app.catalog import get_categories, category_changed, get_catalog_state, get_product_view
+from app.cart import get_cart, update_cart, merge_session_cart, get_cart_pricing, lazy_cart_items, lazy_cart_total
+from app.inventory import get_product_stock, set_warehouse_stock_active, record_stock_movement, MOVEMENT_RESTOCK, MOVEMENT_ADJUSTMENT, MOVEMENT_REMOVAL
+from app.inventory import lock_available_stock, lock_warehouse_stock, plan_allocation, apply_allocation
 from flask_bcrypt import generate_password_hash, check_password_hash
 import re
 import os
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
+from functools import wraps
+import hashlib
 import pymysql
 import random
 
@@ -53,6 +66,64 @@ def save_profile_picture(picture_file, user_id):
 
 main = Blueprint('main', __name__)
 
+def catalog_conditional_get(view):
+    # ETag / Last-Modified for catalog pages. The ETag covers the catalog
+    # version plus everything the page shows per visitor (URL, login, and the
+    # cart when the page renders it), so a 304 skips the queries and the
+    # template entirely. Pages that never show the cart run no cart queries.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Pending flash messages are shown once; never answer those with a 304
+        if request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+        state = get_catalog_state()
+        # Views compare their cached entries against this version
+        g.catalog_version = state['version']
+        # Logged in or holding a cart: decided from the session alone
+        anonymous = not any(key in session for key in ('user_id', 'cart_sid', 'cart'))
+        etag_source = (state['version'], request.full_path, session.get('user_id'), session.get('user_role'))
+
+        def cart_etag(cart):
+            # Tags of pages that rendered the cart carry a 'c-' prefix, so a
+            # revalidation knows to read the cart before comparing
+            return 'c-' + hashlib.sha1(repr(etag_source + (sorted(cart.items()),)).encode()).hexdigest()
+
+        base_etag = hashlib.sha1(repr(etag_source).encode()).hexdigest()
+        etag = base_etag
+        last_modified = state['updated_at'].replace(tzinfo=timezone.utc)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(base_etag)
+            if not not_modified and any(tag.startswith('c-') for tag in request.if_none_match):
+                etag = cart_etag(get_cart())
+                not_modified = request.if_none_match.contains(etag)
+        else:
+            # The timestamp alone does not cover login or cart, so only
+            # anonymous visitors may revalidate by date
+            not_modified = anonymous and request.if_modified_since is not None and last_modified <= request.if_modified_since
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            # The view or its template read the cart: the page depends on it
+            cart = g.get('cart_contents')
+            etag = cart_etag(cart) if cart is not None else base_etag
+
+        response.set_etag(etag)
+        # A response that sets a session cookie is never shared with other visitors
+        if anonymous and not session.modified:
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = current_app.config['CATALOG_CACHE_MAX_AGE']
+        else:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
 # retrieve user addresses
 def get_user_addresses(person_id):
     conn = get_db_connection()
@@ -84,155 +155,40 @@ def home():
         return redirect(url_for('main.login'))
     return redirect(url_for('main.dashboard'))
 
-@main.route('/dashboard')
-def dashboard():
-    user = None
-    if 'user_id' in session:
-        user = {
-            'first_name': session.get('user_first_name'),
-            'role': session.get('user_role')
-        }
+# Store-wide dashboard data; cached in dashboard_cache and shared by every user
+def load_dashboard_snapshot():
     conn = get_db_connection()
     with conn.cursor() as cursor:
-        # Get featured products - mix of different categories
-
-        # highest price products
-        cursor.execute('''
-            SELECT
-                p.*,
-                c.category_name,
-                'highest_price' as feature_type
-            FROM
-                product p
-            JOIN
-                category c 
-                ON p.category_id = c.category_id
-            WHERE p.is_active = TRUE
-            ORDER BY
-                p.price DESC
-            LIMIT 3
-        ''')
-        highest_price_products = cursor.fetchall()
-        
-        # lowest price products
-        cursor.execute('''
-            SELECT
-                p.*,
-                c.category_name,
-                'lowest_price' as feature_type
-            FROM
-                product p
-            JOIN
-                category c 
-                ON p.category_id = c.category_id
-            WHERE p.is_active = TRUE
-            ORDER BY
-                p.price ASC
-            LIMIT 3
-        ''')
-        lowest_price_products = cursor.fetchall()
-        
-        # newest products
-        cursor.execute('''
-            SELECT
-                p.*,
-                c.category_name,
-                'newest' as feature_type
-            FROM
-                product p
-            JOIN
-                category c 
-                ON p.category_id = c.category_id
-            WHERE p.is_active = TRUE
-            ORDER BY
-                p.product_id DESC
-            LIMIT 3
-        ''')
-        newest_products = cursor.fetchall()
-        
-        # most ordered products
-        cursor.execute('''
-            SELECT
-                p.*,
-                c.category_name,
-                'most_ordered' as feature_type
-            FROM
-                product p
-            JOIN
-                category c 
-                ON p.category_id = c.category_id
-            LEFT JOIN
-                Order_Line ol 
-                ON p.product_id = ol.product_id
-            WHERE p.is_active = TRUE
-            GROUP BY
-                p.product_id
-            ORDER BY
-                COUNT(ol.order_line_id) DESC
-            LIMIT 8
-        ''')
-        most_ordered_products = cursor.fetchall()
-        
-        # Combine all featured products
-        featured_products = (
-            highest_price_products[:2] +  # Take 2 highest price
-            lowest_price_products[:2] +   # Take 2 lowest price
-            newest_products[:2] +         # Take 2 newest
-            most_ordered_products[:2]     # Take 2 most ordered
-        )
-        # Newest products (same as featured, but keep for clarity)
-        # Newest products
-        cursor.execute('''
-            SELECT
-                p.*,
-                c.category_name
-            FROM
-                Product p
-            JOIN
-                Category c 
-                ON p.category_id = c.category_id
-            WHERE p.is_active = TRUE
-            ORDER BY
-                p.product_id DESC
-            LIMIT 12
-        ''')
-        newest_products = cursor.fetchall()
+        # Featured, newest and most ordered products (one query, cached)
+        featured = get_featured_products(cursor)
+        featured_products = featured['featured_products']
+        newest_products = featured['newest_products']
+        most_ordered_products = featured['most_ordered_products']
 
         # Most stock products
         cursor.execute('''
             SELECT
                 p.*,
                 c.category_name,
-                SUM(ws.stock_quantity) as total_stock
+                ps.available_stock as total_stock
             FROM
-                Product p
+                Product_Stock ps
+            JOIN
+                Product p 
+                ON ps.product_id = p.product_id
             JOIN
                 Category c 
                 ON p.category_id = c.category_id
-            JOIN
-                Warehouse_Stock ws 
-                ON p.product_id = ws.product_id
-            JOIN
-                Warehouse w ON ws.warehouse_id = w.warehouse_id
             WHERE
-                p.is_active = TRUE AND w.is_active = TRUE
-            GROUP BY
-                p.product_id
+                p.is_active = TRUE AND ps.available_stock > 0
             ORDER BY
-                total_stock DESC
+                ps.available_stock DESC
             LIMIT 12
         ''')
         most_stock_products = cursor.fetchall()
 
         # Categories
-        cursor.execute('''
-            SELECT
-                *
-            FROM
-                Category
-            WHERE is_active = TRUE
-        ''')
-        categories = cursor.fetchall()
+        categories = get_categories(active_only=True)
 
         # User count
         cursor.execute('''
@@ -284,70 +240,12 @@ def dashboard():
         ''')
         warehouse_count = cursor.fetchone()['warehouse_count']
 
-        # Prepare last 6 months labels
-        today = datetime.today().replace(day=1)
-        months = []
-        for i in range(5, -1, -1):
-            month = (today - timedelta(days=30*i))
-            months.append(month.strftime('%b %Y'))
-
-        # Helper to get the last day of a month
-        def last_day_of_month(dt):
-            next_month = dt.replace(day=28) + timedelta(days=4)
-            return next_month - timedelta(days=next_month.day)
-
-        # Get current total stock
-        cursor.execute('''
-            SELECT
-                SUM(ws.stock_quantity) as total_stock
-            FROM
-                Warehouse_Stock ws
-            JOIN
-                Product p ON ws.product_id = p.product_id
-            JOIN
-                Warehouse w ON ws.warehouse_id = w.warehouse_id
-            WHERE
-                p.is_active = TRUE AND w.is_active = TRUE
-        ''')
-        current_total_stock = cursor.fetchone()['total_stock'] or 0
-
-        # For each month, sum the quantity of products ordered in that month
-        orders_per_month = []
-        products_over_time = []
-        stocks_over_time = []
-        orders_qty_per_month = []
-        for i in range(5, -1, -1):
-            month_start = (today - timedelta(days=30*i)).replace(day=1)
-            month_end = last_day_of_month(month_start)
-            # Orders in this month
-            cursor.execute('''
-                SELECT
-                    COUNT(*) as count
-                FROM
-                    Orders
-                WHERE
-                    order_date >= %s AND order_date <= %s
-            ''',
-                (month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d')))
-            orders_per_month.append(cursor.fetchone()['count'])
-            # Products up to end of this month
-            cursor.execute(
-                "SELECT COUNT(*) as count FROM Product WHERE created_at <= %s AND is_active = TRUE",
-                (month_end.strftime('%Y-%m-%d 23:59:59'),)
-            )
-            products_over_time.append(cursor.fetchone()['count'])
-            # Total quantity ordered in this month
-            cursor.execute(
-                "SELECT SUM(ol.quantity) as qty FROM Order_Line ol JOIN Orders o ON ol.order_id = o.order_id JOIN Product p ON ol.product_id = p.product_id WHERE o.order_date >= %s AND o.order_date <= %s AND p.is_active = TRUE",
-                (month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d'))
-            )
-            qty_row = cursor.fetchone()
-            orders_qty_per_month.append(qty_row['qty'] if qty_row and qty_row['qty'] is not None else 0)
-        # Simulate stocks over time (reverse accumulate)
-        running_stock = current_total_stock
-        for qty in reversed(orders_qty_per_month):
-            stocks_over_time.insert(0, running_stock)
-            running_stock += qty
+        # Orders, products and stock for the last 6 calendar months
+        chart_data = monthly_chart_data(cursor, 6)
+        months = chart_data['months']
+        orders_per_month = chart_data['orders_per_month']
+        products_over_time = chart_data['products_over_time']
+        stocks_over_time = chart_data['stocks_over_time']
 
         # Order status breakdown (always show all statuses)
         all_statuses = [
@@ -373,9 +271,7 @@ def dashboard():
         ]
         order_status_colors = [color for _, color in all_statuses]
     conn.close()
-    return render_template(
-        'customer_dashboard.html',
-        user=user,
+    return dict(
         categories=categories,
         featured_products=featured_products,
         newest_products=newest_products,
@@ -394,6 +290,21 @@ def dashboard():
         order_status_colors=order_status_colors
     )
 
+@main.route('/dashboard')
+def dashboard():
+    user = None
+    if 'user_id' in session:
+        user = {
+            'first_name': session.get('user_first_name'),
+            'role': session.get('user_role')
+        }
+    snapshot = dashboard_cache.get_or_set(
+        'snapshot',
+        load_dashboard_snapshot,
+        current_app.config['DASHBOARD_CACHE_TTL']
+    )
+    return render_template('customer_dashboard.html', user=user, **snapshot)
+
 ############################################################################################################
 # Registration
 ############################################################################################################
@@ -437,6 +348,7 @@ def register():
                 VALUES (%s, %s, %s, %s, %s)
             ''', (first_name, last_name, email, hashed_password, 'customer'))
             user_id = cursor.lastrowid
+            record_registration_rollup(cursor)
             if profile_picture and profile_picture.filename:
                 try:
                     picture_path = save_profile_picture(profile_picture, user_id)
@@ -496,9 +408,11 @@ def login():
                 user = cursor.fetchone()
                 
                 if user and check_password_hash(user['passcode'], password):
+                    anonymous_cart_sid = session.pop('cart_sid', None)
                     session['user_id'] = user['person_id']
                     session['user_first_name'] = user['first_name']
                     session['user_role'] = user['role']
+                    merge_session_cart(anonymous_cart_sid)
                     flash('Login successful!', 'success')
                     return redirect(url_for('main.dashboard'))
                 else:
@@ -604,14 +518,32 @@ def profile():
 # Product Browsing
 ############################################################################################################
 @main.route('/products')
+@catalog_conditional_get
 def products():
     category_id = request.args.get('category', type=int)
     search = request.args.get('search', '').strip()
-    sort = request.args.get('sort', 'newest')
+    # Searches rank by relevance unless another order is picked
+    sort = request.args.get('sort') or ('relevance' if search else 'newest')
+    if sort not in PRODUCT_SORTS or (sort == 'relevance' and not search):
+        sort = 'newest'
+    per_page = request.args.get('per_page', PRODUCTS_PER_PAGE, type=int)
+    per_page = min(max(per_page, 1), MAX_PRODUCTS_PER_PAGE)
+    position = decode_cursor(request.args.get('cursor'), sort)
+    # Facet selections; several values of one facet may be picked
+    selected_facets = {
+        'brand': [b for b in request.args.getlist('brand') if b],
+        'price': request.args.getlist('price', type=int),
+        'supplier': request.args.getlist('supplier', type=int),
+        'in_stock': request.args.get('in_stock') == '1',
+    }
+    if search:
+        search_condition, search_params, relevance, relevance_params = product_search(search)
+    else:
+        relevance, relevance_params = '0', []
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Build the complete query with all filtering and sorting in SQL
-        query = '''
+        query = f'''
             WITH product_stats AS (
                 SELECT 
                     p.product_id,
@@ -621,86 +553,111 @@ def products():
                     p.photo,
                     p.category_id,
                     c.category_name,
-                    CASE 
-                        WHEN SUM(ws.stock_quantity) IS NULL THEN 0 
-                        ELSE SUM(ws.stock_quantity) 
-                    END AS stock_quantity,
-                    COUNT(ol.order_line_id) AS order_count
+                    {relevance} AS relevance,
+                    IFNULL(pstock.available_stock, 0) AS stock_quantity,
+                    IFNULL(pst.order_count, 0) AS order_count
                 FROM 
                     Product p
                 JOIN 
                     Category c ON p.category_id = c.category_id
                 LEFT JOIN 
-                    Warehouse_Stock ws ON p.product_id = ws.product_id
+                    Product_Stats pst ON p.product_id = pst.product_id
                 LEFT JOIN 
-                    Order_Line ol ON p.product_id = ol.product_id
+                    Product_Stock pstock ON p.product_id = pstock.product_id
                 WHERE 
                     p.is_active = TRUE
 
         '''
-        params = []
+        params = list(relevance_params)
 
         # Add category filter
         if category_id:
             query += ' AND p.category_id = %s'
             params.append(category_id)
 
-        # Add search filter
+        # Add search filter (FULLTEXT index on name, brand and description)
         if search:
-            query += ' AND (p.product_name LIKE %s OR p.brand LIKE %s)'
-            params.extend([f'%{search}%', f'%{search}%'])
+            query += ' AND ' + search_condition
+            params.extend(search_params)
 
-        # Complete the CTE
+        # Add facet filters
+        conditions, condition_params = facet_filters(
+            selected_facets['brand'], selected_facets['price'],
+            selected_facets['supplier'], selected_facets['in_stock']
+        )
+        for condition in conditions:
+            query += ' AND ' + condition
+        params.extend(condition_params)
+
+        # Keyset pagination: continue after the last row of the previous page
+        if position:
+            condition, condition_params = keyset_condition(sort, position, relevance, relevance_params)
+            query += ' AND ' + condition
+            params.extend(condition_params)
+
+        # Complete the CTE; every row is one product, so nothing to group
         query += '''
-                GROUP BY 
-                    p.product_id, p.product_name, p.brand, p.price, 
-                    p.photo, p.category_id, c.category_name
             )
             SELECT 
-                ps.*,
-                CASE 
-                    WHEN %s = 'price_desc' AND ROW_NUMBER() OVER (ORDER BY ps.price DESC) <= 6 THEN 'highest_price'
-                    WHEN %s = 'price_asc' AND ROW_NUMBER() OVER (ORDER BY ps.price ASC) <= 6 THEN 'lowest_price'
-                    WHEN %s = 'newest' AND ROW_NUMBER() OVER (ORDER BY ps.product_id DESC) <= 6 THEN 'newest'
-                    WHEN ps.order_count > 0 THEN 'most_ordered'
-                    ELSE NULL
-                END as feature_type
+                ps.*
             FROM 
                 product_stats ps
         '''
-        params.extend([sort, sort, sort])
 
-        # Add sorting
-        if sort == 'price_asc':
-            query += ' ORDER BY ps.price ASC'
-        elif sort == 'price_desc':
-            query += ' ORDER BY ps.price DESC'
-        elif sort == 'name_asc':
-            query += ' ORDER BY ps.product_name ASC'
-        elif sort == 'name_desc':
-            query += ' ORDER BY ps.product_name DESC'
-        else:  # newest
-            query += ' ORDER BY ps.product_id DESC'
+        # Add sorting; one extra row tells whether there is a next page
+        query += order_by_clause(sort) + ' LIMIT %s'
+        params.append(per_page + 1)
 
         # Execute the query
         cursor.execute(query, params)
         products = cursor.fetchall()
 
         # Fetch categories for filter bar
-        cursor.execute('SELECT * FROM Category WHERE is_active = TRUE')
-        categories = cursor.fetchall()
+        categories = get_categories(active_only=True)
+
+        # Facet counts for the selected category, from the in-memory index
+        facets = facet_index.counts(cursor, category_id)
 
     conn.close()
-    return render_template('products.html', products=products, categories=categories, selected_category=category_id, search=search, sort=sort)
+
+    next_cursor = None
+    if len(products) > per_page:
+        products = products[:per_page]
+        next_cursor = encode_cursor(sort, products[-1])
+
+    # The first six products of the first page lead their ranking
+    leading_feature = {'price_desc': 'highest_price', 'price_asc': 'lowest_price', 'newest': 'newest'}.get(sort)
+    for index, product in enumerate(products):
+        if leading_feature and not position and index < 6:
+            product['feature_type'] = leading_feature
+        elif product['order_count'] > 0:
+            product['feature_type'] = 'most_ordered'
+        else:
+            product['feature_type'] = None
+
+    return render_template('products.html', products=products, categories=categories, selected_category=category_id, search=search, sort=sort,
+                           per_page=per_page, cursor=request.args.get('cursor') if position else None, next_cursor=next_cursor,
+                           facets=facets, selected_facets=selected_facets)
+
+@main.route('/products/autocomplete')
+def product_autocomplete():
+    # Served from the in-memory index; the request itself never touches MySQL
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    limit = min(max(limit, 1), MAX_AUTOCOMPLETE_LIMIT)
+    suggestions = suggest_products(query, limit)
+    for suggestion in suggestions:
+        if suggestion['type'] == 'product':
+            suggestion['url'] = url_for('main.product_details', product_id=suggestion['product_id'])
+        else:
+            suggestion['url'] = url_for('main.products', search=suggestion['label'])
+    return jsonify({'query': query, 'suggestions': suggestions})
 
 @main.route('/categories')
+@catalog_conditional_get
 def categories_view():
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        # Fetch categories for header/modal and page display
-        cursor.execute('SELECT * FROM Category WHERE is_active = TRUE') # Fetch all categories for modal and page content
-        categories = cursor.fetchall()
-    conn.close()
+    # Fetch categories for header/modal and page display
+    categories = get_categories(active_only=True)
     return render_template('categories.html', categories=categories)
 
 @main.route('/categories/<int:category_id>')
@@ -708,43 +665,16 @@ def category_products(category_id):
     return redirect(url_for('main.products', category=category_id))
 
 @main.route('/products/<int:product_id>')
+@catalog_conditional_get
 def product_details(product_id):
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-
-        # Product details
-        cursor.execute('''
-            SELECT p.*, c.category_name 
-            FROM Product p 
-            JOIN Category c ON p.category_id = c.category_id 
-            WHERE p.product_id = %s AND p.is_active = TRUE
-        ''', (product_id,))
-        product = cursor.fetchone()
-
-        # Categories
-        cursor.execute('SELECT * FROM Category')
-        categories = cursor.fetchall()
-
-        # Stock quantity
-        cursor.execute('SELECT SUM(ws.stock_quantity) as total_stock FROM Warehouse_Stock ws JOIN Warehouse w ON ws.warehouse_id = w.warehouse_id WHERE ws.product_id = %s AND w.is_active = TRUE', (product_id,))
-        stock_row = cursor.fetchone()
-        stock_quantity = stock_row['total_stock'] if stock_row and stock_row['total_stock'] is not None else 0
-        
-        # Fetch suppliers for this product
-        cursor.execute('''
-            SELECT s.supplier_id, s.supplier_name
-            FROM Supplier s
-            JOIN Supplier_Product sp ON s.supplier_id = sp.supplier_id
-            WHERE sp.product_id = %s AND s.is_active = TRUE
-            ORDER BY s.supplier_name ASC
-        ''', (product_id,))
-        suppliers = cursor.fetchall()
-        
-    conn.close()
-    if not product:
+    # Product, stock and suppliers come from one cached query
+    view = get_product_view(product_id, g.get('catalog_version'))
+    if not view:
         flash('Product not found.', 'danger')
         return redirect(url_for('main.products'))
-    return render_template('product_details.html', product=product, categories=categories, stock_quantity=stock_quantity, suppliers=suppliers)
+    categories = get_categories()
+    return render_template('product_details.html', product=view['product'], categories=categories,
+                           stock_quantity=view['stock_quantity'], suppliers=view['suppliers'])
 
 ############################################################################################################
 # Cart
@@ -752,44 +682,19 @@ def product_details(product_id):
 @main.route('/cart/add/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     quantity = int(request.form.get('quantity', 1))
-    cart = session.get('cart', {})
-    cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
-    session['cart'] = cart
+    update_cart(add={product_id: quantity})
     flash('Product added to cart!', 'success')
     return redirect(request.referrer or url_for('main.products'))
 
 @main.route('/cart')
 def view_cart():
-    cart = session.get('cart', {})
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        product_ids = list(map(int, cart.keys()))
-        if product_ids:
-            format_strings = ','.join(['%s'] * len(product_ids))
-            cursor.execute(f"SELECT * FROM Product WHERE product_id IN ({format_strings}) AND is_active = TRUE", tuple(product_ids))
-            products = cursor.fetchall()
-        else:
-            products = []
-    conn.close()
-    cart_items = []
-    total = 0
-    for product in products:
-        pid = str(product['product_id'])
-        quantity = cart[pid]
-        subtotal = product['price'] * quantity
-        total += subtotal
-        cart_items.append({
-            'product': product,
-            'quantity': quantity,
-            'subtotal': subtotal
-        })
-    return render_template('cart.html', cart_items=cart_items, total=total)
+    # Priced once per request; the header reuses the same result
+    pricing = get_cart_pricing()
+    return render_template('cart.html', cart_items=pricing['cart_items'], total=pricing['total'])
 
 @main.route('/cart/remove/<int:product_id>', methods=['POST'])
 def remove_from_cart(product_id):
-    cart = session.get('cart', {})
-    cart.pop(str(product_id), None)
-    session['cart'] = cart
+    update_cart(remove=[product_id])
     flash('Product removed from cart.', 'success')
     from_place_order = request.form.get('from_place_order')
     if from_place_order:
@@ -799,10 +704,80 @@ def remove_from_cart(product_id):
 
 @main.route('/cart/clear', methods=['POST'])
 def clear_cart():
-    session.pop('cart', None)
+    update_cart(clear=True)
     flash('Your cart has been cleared.', 'success')
     return redirect(url_for('main.view_cart'))
 
+def cart_json():
+    pricing = get_cart_pricing()
+    return jsonify({
+        'items': [{
+            'product_id': item['product']['product_id'],
+            'product_name': item['product']['product_name'],
+            'price': float(item['product']['price']),
+            'quantity': item['quantity'],
+            'subtotal': float(item['subtotal']),
+        } for item in pricing['cart_items']],
+        'total': float(pricing['total']),
+    })
+
+def parse_cart_items(payload):
+    # [{"product_id": 1, "quantity": 2}, ...] -> {1: 2}; None if malformed
+    entries = payload.get('items', [])
+    if not isinstance(entries, list):
+        return None
+    items = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            return None
+        try:
+            items[int(entry['product_id'])] = int(entry['quantity'])
+        except (KeyError, TypeError, ValueError):
+            return None
+    return items
+
+@main.route('/api/cart', methods=['GET'])
+def api_cart():
+    return cart_json()
+
+@main.route('/api/cart/items', methods=['POST', 'PUT', 'DELETE'])
+def api_cart_items():
+    # POST adds quantities, PUT sets them (0 removes), DELETE removes the
+    # listed product_ids or empties the cart when none are given
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {}
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Expected a JSON object.'}), 400
+    if request.method == 'DELETE':
+        product_ids = payload.get('product_ids')
+        if product_ids is not None and not isinstance(product_ids, list):
+            return jsonify({'error': 'product_ids must be a list of product ids.'}), 400
+        if product_ids:
+            try:
+                update_cart(remove=[int(product_id) for product_id in product_ids])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'product_ids must be a list of product ids.'}), 400
+        else:
+            update_cart(clear=True)
+        return cart_json()
+
+    items = parse_cart_items(payload)
+    if not items:
+        return jsonify({'error': 'Expected {"items": [{"product_id": ..., "quantity": ...}]}.'}), 400
+    products = product_cache.get_many(items.keys())
+    unknown = sorted(pid for pid, quantity in items.items()
+                     if quantity > 0 and (pid not in products or not products[pid]['is_active']))
+    if unknown:
+        return jsonify({'error': 'Unknown or archived products.', 'product_ids': unknown}), 404
+    if request.method == 'POST':
+        if any(quantity <= 0 for quantity in items.values()):
+            return jsonify({'error': 'Quantities to add must be positive.'}), 400
+        update_cart(add=items)
+    else:
+        update_cart(set_quantities=items)
+    return cart_json()
+
 ############################################################################################################
 # Orders
 ############################################################################################################
@@ -819,30 +794,9 @@ def place_order():
     ]
 
     person_id = session['user_id']
-    cart = session.get('cart', {})
-    cart_items = []
+    cart_items = get_cart_pricing()['cart_items']
     estimated_shipping_days = None
     estimated_delivery_days = None
-    if cart:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            product_ids = list(map(int, cart.keys()))
-            if product_ids:
-                format_strings = ','.join(['%s'] * len(product_ids))
-                cursor.execute(f"SELECT * FROM Product WHERE product_id IN ({format_strings})", tuple(product_ids))
-                products = cursor.fetchall()
-            else:
-                products = []
-        conn.close()
-        for product in products:
-            pid = str(product['product_id'])
-            quantity = cart[pid]
-            subtotal = product['price'] * quantity
-            cart_items.append({
-                'product': product,
-                'quantity': quantity,
-                'subtotal': subtotal
-            })
     # --- Calculate estimated shipping/delivery days based on system load and last N orders ---
     conn = get_db_connection()
    
@@ -881,7 +835,7 @@ def place_order():
         if not address_id:
             flash('Please select an address.', 'danger')
             return redirect(url_for('main.place_order'))
-        if not cart:
+        if not cart_items:
             flash('Your cart is empty.', 'danger')
             return redirect(url_for('main.products'))
         payment_method = request.form.get('payment_method')
@@ -903,16 +857,14 @@ def place_order():
         conn = get_db_connection()
         try:
             with conn.cursor() as cursor:
-                # Lock stock rows for update to prevent race conditions
-                for item in cart_items:
-                    product_id = item['product']['product_id']
-                    cursor.execute('SELECT SUM(stock_quantity) as total_stock FROM Warehouse_Stock ws JOIN Product p ON ws.product_id = p.product_id WHERE ws.product_id = %s AND p.is_active = TRUE FOR UPDATE', (product_id,))
-                    row = cursor.fetchone()
-                    total_stock = row['total_stock'] if row and row['total_stock'] is not None else 0
-                    if total_stock < item['quantity']:
-                        flash(f"Not enough stock for {item['product']['product_name']} (needed: {item['quantity']}, available: {total_stock})", 'danger')
-                        conn.rollback()
-                        return redirect(url_for('main.place_order'))
+                # Lock the stock totals of the whole cart at once and report every shortage
+                shortages = lock_available_stock(cursor, {item['product']['product_id']: item['quantity'] for item in cart_items})
+                if shortages:
+                    names = {item['product']['product_id']: item['product']['product_name'] for item in cart_items}
+                    for product_id, needed, available in shortages:
+                        flash(f"Not enough stock for {names[product_id]} (needed: {needed}, available: {available})", 'danger')
+                    conn.rollback()
+                    return redirect(url_for('main.place_order'))
                 # Place order and order lines
                 cursor.execute(
                     'INSERT INTO Orders (person_id, address_id, order_date, order_status, order_type, shipping_cost) VALUES (%s, %s, NOW(), %s, %s, %s)',
@@ -922,24 +874,19 @@ def place_order():
                 # Assign shipped_day and expected_delivery_day based on calculated values
                 cursor.execute('UPDATE Orders SET shipped_day = %s, expected_delivery_day = %s WHERE order_id = %s',
                                (shipped_day, expected_delivery_day, order_id))
-                for item in cart_items:
-                    cursor.execute(
-                        'INSERT INTO Order_Line (order_id, product_id, quantity, order_line_states) VALUES (%s, %s, %s, %s)',
-                        (order_id, item['product']['product_id'], item['quantity'], 'Processing')
-                    )
-                # Deduct stock from warehouses (prioritize largest stock first)
-                for item in cart_items:
-                    product_id = item['product']['product_id']
-                    quantity_to_deduct = item['quantity']
-                    cursor.execute('SELECT warehouse_id, stock_quantity FROM Warehouse_Stock ws JOIN Product p ON ws.product_id = p.product_id WHERE ws.product_id = %s AND ws.stock_quantity > 0 AND p.is_active = TRUE ORDER BY stock_quantity DESC FOR UPDATE', (product_id,))
-                    warehouses = cursor.fetchall()
-                    for wh in warehouses:
-                        if quantity_to_deduct <= 0:
-                            break
-                        deduct = min(wh['stock_quantity'], quantity_to_deduct)
-                        cursor.execute('UPDATE Warehouse_Stock SET stock_quantity = stock_quantity - %s WHERE warehouse_id = %s AND product_id = %s',
-                                       (deduct, wh['warehouse_id'], product_id))
-                        quantity_to_deduct -= deduct
+                cursor.executemany(
+                    'INSERT INTO Order_Line (order_id, product_id, quantity, order_line_states) VALUES (%s, %s, %s, %s)',
+                    [(order_id, item['product']['product_id'], item['quantity'], 'Processing') for item in cart_items]
+                )
+                # Keep the per-product order counters in step with Order_Line
+                record_product_orders(cursor, [(item['product']['product_id'], item['quantity']) for item in cart_items])
+                # Plan the deduction from one locked read (fewest warehouses, nearest
+                # to the delivery city), then apply it set-based and record where each line ships from
+                quantities = {item['product']['product_id']: item['quantity'] for item in cart_items}
+                cursor.execute('SELECT city FROM Address WHERE address_id = %s', (address_id,))
+                address = cursor.fetchone()
+                plan = plan_allocation(lock_warehouse_stock(cursor, quantities), quantities, address['city'] if address else None)
+                apply_allocation(cursor, order_id, plan)
 
                 payment_states = 'Pending'
                 card_last_four_digits = None
@@ -986,17 +933,27 @@ def place_order():
                     'INSERT INTO Payment (order_id, payment_method, amount_payment_date, payment_states, card_last_four_digits, cardholder_name, expiration_date, hashed_card_number) VALUES (%s, %s, NOW(), %s, %s, %s, %s, %s)',
                     (order_id, payment_method, payment_states, card_last_four_digits, cardholder_name, expiration_date, hashed_card_number if payment_method == 'Credit Card' else None)
                 )
+                record_order_rollup(
+                    cursor,
+                    order_id,
+                    sum(item['quantity'] for item in cart_items),
+                    sum(item['subtotal'] for item in cart_items),
+                    payment_method == 'Cash on Delivery'
+                )
                 conn.commit()
-
-            flash('Order placed successfully!', 'success')
-            session['cart'] = {}
-            return redirect(url_for('main.orders'))
         except Exception as e:
             conn.rollback()
             flash(f'Error placing order: {e}', 'danger')
             return redirect(url_for('main.place_order'))
         finally:
             conn.close()
+
+        # The order is committed: nothing below may report it as failed
+        update_cart(clear=True)
+        invalidate_dashboard_cache()
+        stock_changed([item['product']['product_id'] for item in cart_items])
+        flash('Order placed successfully!', 'success')
+        return redirect(url_for('main.orders'))
     addresses = get_user_addresses(person_id)
 
     # Ensure available_payment_methods is passed for GET requests and POST failures
@@ -1249,6 +1206,7 @@ def add_address():
             (person_id, city, street_address)
         )
         conn.commit()
+    conn.close()
     flash('Address added successfully!', 'success')
     return redirect(request.referrer or url_for('main.place_order'))
 
@@ -1265,273 +1223,74 @@ def admin_dashboard():
         'first_name': session.get('user_first_name'),
         'role': session.get('user_role')
     }
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        # Stats
-        # this will count all users that are customers 
-        cursor.execute("SELECT COUNT(*) AS user_count FROM Person WHERE role = 'customer' AND is_active = TRUE")
-        user_count = cursor.fetchone()['user_count']
 
-        # this will count all users that are staff
-        cursor.execute("SELECT COUNT(*) AS staff_count FROM Person WHERE role = 'staff' AND is_active = TRUE")
-        staff_count = cursor.fetchone()['staff_count']
+    # Month window for the sales charts (last 6 calendar months)
+    month_starts = last_n_months(6)
+    months_window = (month_starts[0], next_month(month_starts[-1]))
 
-        # this will count all orders
-        cursor.execute("SELECT COUNT(*) AS order_count FROM Orders")
-        order_count = cursor.fetchone()['order_count']
+    # The page itself only carries the KPI cards and light charts; slower
+    # widgets are fetched by the browser from admin_widget() in parallel.
+    # Every query below is independent, so they run concurrently on separate
+    # pooled connections and the page waits for the slowest one only
+    results = fan_out({
+        # this will count all users that are customers
+        'user_count': ("SELECT COUNT(*) AS user_count FROM Person WHERE role = 'customer' AND is_active = TRUE", None),
 
+        # this will count all users that are staff
+        'staff_count': ("SELECT COUNT(*) AS staff_count FROM Person WHERE role = 'staff' AND is_active = TRUE", None),
 
-        # Calculate total sales (including COD only when delivered) 
-        # if the order is delivered, then the payment method is not cash on delivery
+        # this will count all orders
+        'order_count': ("SELECT COUNT(*) AS order_count FROM Orders", None),
 
-        #****************mahmoud check if this is correct****************************************************************
-        cursor.execute('''
+        # Calculate total sales (including COD only when delivered)
+        'total_sales': ('''
             SELECT IFNULL(SUM(ol.quantity * p.price), 0) AS total_sales
             FROM Order_Line ol
             JOIN Product p ON ol.product_id = p.product_id
             JOIN Orders o ON ol.order_id = o.order_id
             LEFT JOIN Payment pay ON o.order_id = pay.order_id
             WHERE (pay.payment_method != 'Cash on Delivery' OR o.order_status = 'Delivered') AND p.is_active = TRUE
-        ''')
-
-        #****************mahmoud these four queries are correct there is no need to check them *******************************************
-
-        # this will count all products
-        total_sales = float(cursor.fetchone()['total_sales'] or 0)
-        cursor.execute("SELECT COUNT(*) AS product_count FROM Product WHERE is_active = TRUE")
-
-        # this will count all categories
-        product_count = cursor.fetchone()['product_count']
-        cursor.execute("SELECT COUNT(*) AS category_count FROM Category WHERE is_active = TRUE")
-        category_count = cursor.fetchone()['category_count']
+        ''', None),
 
-        # this will count all warehouses
-        cursor.execute("SELECT COUNT(*) AS warehouse_count FROM Warehouse WHERE is_active = TRUE")
-        warehouse_count = cursor.fetchone()['warehouse_count']
-        
-        # Get supplier count
-        cursor.execute("SELECT COUNT(*) AS supplier_count FROM Supplier WHERE is_active = TRUE")
-        supplier_count = cursor.fetchone()['supplier_count']
-
-
-        #**********************************************************************************************************************
-    
-        # this will count all products and their total quantity sold
-        cursor.execute('''
-            SELECT 
-                p.product_id,
-                p.price,
-                IFNULL(SUM(ol.quantity), 0) as total_quantity_sold
-            FROM 
-                Product p
-            LEFT JOIN 
-                Order_Line ol ON p.product_id = ol.product_id
-            GROUP BY 
-                p.product_id, p.price
-        ''')
-        products_data = cursor.fetchall()
-        
-        total_profit = 0
-        for product in products_data:
-            price = float(product['price'])
-            quantity_sold = int(product['total_quantity_sold'] or 0)
-            
-            # Calculate profit based on price ranges
-            if price <= 10.00:
-                profit = (price * 0.40 + 1.50) * quantity_sold
-            elif price <= 50.00:
-                profit = (price * 0.30 + 2.00) * quantity_sold
-            elif price <= 150.00:
-                profit = (price * 0.25) * quantity_sold
-            elif price <= 500.00:
-                profit = (price * 0.20) * quantity_sold
-            elif price <= 1000.00:
-                profit = (price * 0.15) * quantity_sold
-            elif price <= 2500.00:
-                profit = (price * 0.12) * quantity_sold
-            elif price <= 5000.00:
-                profit = (price * 0.10) * quantity_sold
-            else:
-                profit = (price * 0.08) * quantity_sold
-                
-            total_profit += profit
-        
-        # ************************************************Ameer there is no need to check this query ********************************************************************
+        # this will count all products, categories, warehouses and suppliers
+        'product_count': ("SELECT COUNT(*) AS product_count FROM Product WHERE is_active = TRUE", None),
+        'category_count': ("SELECT COUNT(*) AS category_count FROM Category WHERE is_active = TRUE", None),
+        'warehouse_count': ("SELECT COUNT(*) AS warehouse_count FROM Warehouse WHERE is_active = TRUE", None),
+        'supplier_count': ("SELECT COUNT(*) AS supplier_count FROM Supplier WHERE is_active = TRUE", None),
 
         # this will count the total number of stock items (sum of all stock quantities)
-        cursor.execute('''
+        'total_stock_count': ('''
             SELECT 
-                IFNULL(SUM(ws.stock_quantity), 0) AS total_stock_count 
+                IFNULL(SUM(available_stock), 0) AS total_stock_count 
             FROM 
-                Warehouse_Stock ws
-            JOIN
-                Warehouse w ON ws.warehouse_id = w.warehouse_id
-            WHERE
-                w.is_active = TRUE
-        ''')
-        total_stock_count = cursor.fetchone()['total_stock_count']
-
+                Product_Stock
+        ''', None),
 
-        # this will count the number of unique addresses used in orders (this is correct)
-        cursor.execute('''
+        # this will count the number of unique addresses used in orders
+        'shipped_addresses_count': ('''
             SELECT 
                 COUNT(DISTINCT address_id) AS shipped_addresses_count 
             FROM 
                 Orders
-        ''')
-        shipped_addresses_count = cursor.fetchone()['shipped_addresses_count']
-        
-        #******************************************* Ameer I think this query is correct but I am not sure ********************************************************************
-        # Recent orders (last 5)
-        cursor.execute('''
-            SELECT 
-                o.order_id, 
-                o.order_date, 
-                o.order_status, 
-                o.order_type, 
-                o.person_id, 
-                p.first_name, 
-                p.last_name,
-                (
-                    SELECT 
-                        SUM(ol.quantity * pr.price) 
-                    FROM 
-                        Order_Line ol 
-                    JOIN 
-                        Product pr 
-                        ON ol.product_id = pr.product_id 
-                    WHERE 
-                        ol.order_id = o.order_id
-                ) AS total
-            FROM 
-                Orders o
-            JOIN 
-                Person p 
-                ON o.person_id = p.person_id
-            ORDER BY 
-                o.order_date DESC, 
-                o.order_id DESC
-            LIMIT 5
-        ''')
-        recent_orders = cursor.fetchall()
-        
-        #******************************************* this query is correct ********************************************************************
+        ''', None),
 
-        # Recent users (last 5)
-        cursor.execute('''
+        # Orders and sales per month, read from the daily rollups (~180 rows)
+        'monthly_rollup': ('''
             SELECT 
-                person_id, 
-                first_name, 
-                last_name, 
-                email, 
-                created_at 
+                DATE_FORMAT(rollup_date, '%%Y-%%m') AS month_key,
+                SUM(orders) AS orders,
+                SUM(gross_sales - cod_pending_sales) AS sales
             FROM 
-                Person 
+                Daily_Rollup 
             WHERE 
-                role = 'customer' 
-            ORDER BY 
-                created_at DESC, 
-                person_id DESC 
-            LIMIT 5
-        ''')
-        recent_users = cursor.fetchall()
-        
-        
-        #******************************************* these queries need to be checked ********************************************************************
-        # Orders per month (last 6 months)
-        today = datetime.today().replace(day=1)
-        months = []
-        orders_per_month = []
-        sales_per_month = []
-        for i in range(5, -1, -1):
-            month_start = (today - timedelta(days=30*i)).replace(day=1)
-            month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-            months.append(month_start.strftime('%b %Y'))
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as count 
-                FROM 
-                    Orders 
-                WHERE 
-                    order_date >= %s 
-                    AND order_date <= %s
-            ''', (month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d')))
-            orders_per_month.append(cursor.fetchone()['count'])
-            cursor.execute('''
-                SELECT 
-                    IFNULL(SUM(ol.quantity * p.price), 0) as sales 
-                FROM 
-                    Orders o 
-                JOIN 
-                    Order_Line ol 
-                    ON o.order_id = ol.order_id 
-                JOIN 
-                    Product p 
-                    ON ol.product_id = p.product_id 
-                LEFT JOIN Payment pay ON o.order_id = pay.order_id
-                WHERE 
-                    o.order_date >= %s 
-                    AND o.order_date <= %s
-                    AND (pay.payment_method != 'Cash on Delivery' OR o.order_status = 'Delivered')
-            ''', (month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d')))
-            sales_per_month.append(float(cursor.fetchone()['sales'] or 0))
-        
-        # Get daily order count for the last 30 days
-        today = datetime.now().date()
-        thirty_days_ago = today - timedelta(days=30)
-        cursor.execute('''
-            SELECT
-                DATE(order_date) AS order_day,
-                COUNT(*) AS order_count
-            FROM
-                Orders
-            WHERE
-                order_date >= %s
-            GROUP BY
-                order_day
-            ORDER BY
-                order_day ASC
-        ''', (thirty_days_ago.strftime('%Y-%m-%d'),))
-        daily_orders_data = cursor.fetchall()
-        
-        # Create a list of dates for the last 30 days and merge with query results
-        date_list = [(thirty_days_ago + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(31)]
-        daily_order_counts = {row['order_day'].strftime('%Y-%m-%d'): row['order_count'] for row in daily_orders_data}
-        orders_per_day = [daily_order_counts.get(date, 0) for date in date_list]
-
-        # Get daily user registration count for the last 30 days (using created_at column)
-        cursor.execute('''
-            SELECT
-                DATE(created_at) AS registration_day,
-                COUNT(*) AS registration_count
-            FROM
-                Person
-            WHERE
-                created_at >= %s
-            GROUP BY
-                registration_day
-            ORDER BY
-                registration_day ASC
-        ''', (thirty_days_ago.strftime('%Y-%m-%d 00:00:00'),))
-        daily_registrations_data = cursor.fetchall()
-
-        # Create a list of dates for the last 30 days and merge with query results
-        # Reuse date_list from above
-        daily_registration_counts = {row['registration_day'].strftime('%Y-%m-%d'): row['registration_count'] for row in daily_registrations_data}
-        registrations_per_day = [daily_registration_counts.get(date, 0) for date in date_list]
-
-
-
-        #******************************************* this query is checked and its correct ********************************************************************  
+                rollup_date >= %s 
+                AND rollup_date < %s
+            GROUP BY 
+                month_key
+        ''', months_window),
 
-        # Order status breakdown (always show all statuses)
-        all_statuses = [
-            ('Processing', '#ffc107'),
-            ('Shipped', '#28a745'),
-            ('Delivered', '#007bff'),
-            ('Cancelled', '#dc3545')
-        ]
-        cursor.execute('''
+        # Order status breakdown
+        'order_status': ('''
             SELECT 
                 order_status, 
                 COUNT(*) as count 
@@ -1539,21 +1298,10 @@ def admin_dashboard():
                 Orders 
             GROUP BY 
                 order_status
-        ''')
-        raw_status_data = cursor.fetchall()
-        status_count_map = {row['order_status']: row['count'] for row in raw_status_data}
-        order_status_data = [
-            {'order_status': status, 'count': status_count_map.get(status, 0)}
-            for status, _ in all_statuses
-        ]
-        order_status_colors = [color for _, color in all_statuses]
-
-
+        ''', None),
 
-        #******************************************* this query is checked and its correct ********************************************************************  
-        
         # Calculate total stock value
-        cursor.execute('''
+        'total_stock_value': ('''
             SELECT 
                 IFNULL(SUM(ws.stock_quantity * p.price), 0) as total_stock_value 
             FROM 
@@ -1565,14 +1313,10 @@ def admin_dashboard():
                 Warehouse w ON ws.warehouse_id = w.warehouse_id
             WHERE
                 w.is_active = TRUE
-        ''')
-        total_stock_value = float(cursor.fetchone()['total_stock_value'] or 0)
-        
-
-        #******************************************* No need to check this query ********************************************************************  
+        ''', None),
 
         # Calculate user type breakdown
-        cursor.execute('''
+        'user_type_data': ('''
             SELECT 
                 role, 
                 COUNT(*) as count 
@@ -1580,77 +1324,51 @@ def admin_dashboard():
                 Person 
             GROUP BY 
                 role
-        ''')
-        user_type_data = cursor.fetchall()
-        
-        # Fetch categories for the navigation menu
-        cursor.execute('SELECT * FROM Category')
-        categories = cursor.fetchall()
-
-
-        
-        #******************************************* this query is checked and its correct ********************************************************************  
-
-
-        # Top 5 best-selling products
-        cursor.execute('''
-            SELECT 
-                p.product_name, 
-                SUM(ol.quantity) as total_qty
-            FROM 
-                Order_Line ol
-            JOIN 
-                Product p 
-                ON ol.product_id = p.product_id
-            GROUP BY 
-                ol.product_id
-            ORDER BY 
-                total_qty DESC
-            LIMIT 5
-        ''')
-        top_products = cursor.fetchall()
-
+        ''', None),
+    })
+
+    user_count = results['user_count'][0]['user_count']
+    staff_count = results['staff_count'][0]['staff_count']
+    order_count = results['order_count'][0]['order_count']
+    total_sales = float(results['total_sales'][0]['total_sales'] or 0)
+    product_count = results['product_count'][0]['product_count']
+    category_count = results['category_count'][0]['category_count']
+    warehouse_count = results['warehouse_count'][0]['warehouse_count']
+    supplier_count = results['supplier_count'][0]['supplier_count']
+    total_stock_count = results['total_stock_count'][0]['total_stock_count']
+    shipped_addresses_count = results['shipped_addresses_count'][0]['shipped_addresses_count']
+    total_stock_value = float(results['total_stock_value'][0]['total_stock_value'] or 0)
+    user_type_data = results['user_type_data']
+    categories = get_categories()
+
+    # Fill the month series, including months without orders
+    months = [m.strftime('%b %Y') for m in month_starts]
+    month_keys = [month_key(m) for m in month_starts]
+    monthly_orders = {row['month_key']: int(row['orders'] or 0) for row in results['monthly_rollup']}
+    monthly_sales = {row['month_key']: float(row['sales'] or 0) for row in results['monthly_rollup']}
+    orders_per_month = [monthly_orders.get(key, 0) for key in month_keys]
+    sales_per_month = [monthly_sales.get(key, 0.0) for key in month_keys]
+
+    # Order status breakdown (always show all statuses)
+    all_statuses = [
+        ('Processing', '#ffc107'),
+        ('Shipped', '#28a745'),
+        ('Delivered', '#007bff'),
+        ('Cancelled', '#dc3545')
+    ]
+    status_count_map = {row['order_status']: row['count'] for row in results['order_status']}
+    order_status_data = [
+        {'order_status': status, 'count': status_count_map.get(status, 0)}
+        for status, _ in all_statuses
+    ]
+    order_status_colors = [color for _, color in all_statuses]
 
-        #******************************************* this query is correct ********************************************************************  
-        
-        # Warehouse stock breakdown
-        cursor.execute('''
-            SELECT 
-                w.location_name, 
-                SUM(ws.stock_quantity) as total_stock
-            FROM 
-                Warehouse_Stock ws
-            JOIN 
-                Warehouse w 
-                ON ws.warehouse_id = w.warehouse_id
-            GROUP BY 
-                ws.warehouse_id
-        ''')
-        warehouse_stock_data = cursor.fetchall()
-        
+    # admin_dashboard.html still renders the widget sections itself, so pass
+    # their (cached) data along until the page fetches them from widget_urls
+    widget_data = {}
+    for name in ADMIN_WIDGETS:
+        widget_data.update(get_admin_widget(name))
 
-        #***************************************************************************************************************  
-        # Category sales breakdown
-        cursor.execute('''
-            SELECT 
-                c.category_name, 
-                IFNULL(SUM(ol.quantity * p.price), 0) as sales 
-            FROM 
-                Category c
-            LEFT JOIN 
-                Product p 
-                ON p.category_id = c.category_id
-            LEFT JOIN 
-                Order_Line ol 
-                ON ol.product_id = p.product_id
-            GROUP BY 
-                c.category_id
-            ORDER BY 
-                sales DESC
-        ''')
-        category_sales_data = cursor.fetchall()
-        
-        conn.close()
     return render_template(
         'admin_dashboard.html',
         user=user,
@@ -1665,8 +1383,6 @@ def admin_dashboard():
         supplier_count=supplier_count,
         total_stock_count=total_stock_count,
         shipped_addresses_count=shipped_addresses_count,
-        recent_orders=recent_orders,
-        recent_users=recent_users,
         months=months,
         orders_per_month=orders_per_month,
         sales_per_month=sales_per_month,
@@ -1674,16 +1390,211 @@ def admin_dashboard():
         order_status_colors=order_status_colors,
         total_stock_value=total_stock_value,
         user_type_data=user_type_data,
-        top_products=top_products,
-        warehouse_stock_data=warehouse_stock_data,
-        category_sales_data=category_sales_data,
-        products_data=products_data,
-        total_profit=total_profit,
-        dates_30_days=date_list, # Pass the date list for chart labels
-        orders_per_day=orders_per_day, # Pass daily order data
-        registrations_per_day=registrations_per_day # Pass daily registration data
+        widget_urls={name: url_for('main.admin_widget', widget=name) for name in ADMIN_WIDGETS},
+        **widget_data
     )
 
+# Admin dashboard widgets, served as JSON and loaded by the page after it renders
+def load_recent_orders_widget(cursor):
+    # Recent orders (last 5)
+    cursor.execute('''
+        SELECT 
+            o.order_id, 
+            o.order_date, 
+            o.order_status, 
+            o.order_type, 
+            o.person_id, 
+            p.first_name, 
+            p.last_name,
+            (
+                SELECT 
+                    SUM(ol.quantity * pr.price) 
+                FROM 
+                    Order_Line ol 
+                JOIN 
+                    Product pr 
+                    ON ol.product_id = pr.product_id 
+                WHERE 
+                    ol.order_id = o.order_id
+            ) AS total
+        FROM 
+            Orders o
+        JOIN 
+            Person p 
+            ON o.person_id = p.person_id
+        ORDER BY 
+            o.order_date DESC, 
+            o.order_id DESC
+        LIMIT 5
+    ''')
+    return {'recent_orders': cursor.fetchall()}
+
+def load_recent_users_widget(cursor):
+    # Recent users (last 5)
+    cursor.execute('''
+        SELECT 
+            person_id, 
+            first_name, 
+            last_name, 
+            email, 
+            created_at 
+        FROM 
+            Person 
+        WHERE 
+            role = 'customer' 
+        ORDER BY 
+            created_at DESC, 
+            person_id DESC 
+        LIMIT 5
+    ''')
+    return {'recent_users': cursor.fetchall()}
+
+def load_daily_series_widget(cursor):
+    # Daily orders and registrations for the last 30 days, from the rollups
+    thirty_days_ago = datetime.now().date() - timedelta(days=30)
+    cursor.execute('''
+        SELECT
+            rollup_date,
+            orders,
+            registrations
+        FROM
+            Daily_Rollup
+        WHERE
+            rollup_date >= %s
+    ''', (thirty_days_ago,))
+    daily_rows = {row['rollup_date'].strftime('%Y-%m-%d'): row for row in cursor.fetchall()}
+    date_list = [(thirty_days_ago + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(31)]
+    return {
+        'dates_30_days': date_list,
+        'orders_per_day': [daily_rows[date]['orders'] if date in daily_rows else 0 for date in date_list],
+        'registrations_per_day': [daily_rows[date]['registrations'] if date in daily_rows else 0 for date in date_list]
+    }
+
+def load_category_sales_widget(cursor):
+    # Category sales breakdown
+    cursor.execute('''
+        SELECT 
+            c.category_name, 
+            IFNULL(SUM(ol.quantity * p.price), 0) as sales 
+        FROM 
+            Category c
+        LEFT JOIN 
+            Product p 
+            ON p.category_id = c.category_id
+        LEFT JOIN 
+            Order_Line ol 
+            ON ol.product_id = p.product_id
+        GROUP BY 
+            c.category_id
+        ORDER BY 
+            sales DESC
+    ''')
+    return {'category_sales_data': [
+        {'category_name': row['category_name'], 'sales': float(row['sales'])}
+        for row in cursor.fetchall()
+    ]}
+
+def load_warehouse_stock_widget(cursor):
+    # Warehouse stock breakdown
+    cursor.execute('''
+        SELECT 
+            w.location_name, 
+            SUM(ws.stock_quantity) as total_stock
+        FROM 
+            Warehouse_Stock ws
+        JOIN 
+            Warehouse w 
+            ON ws.warehouse_id = w.warehouse_id
+        GROUP BY 
+            ws.warehouse_id
+    ''')
+    return {'warehouse_stock_data': [
+        {'location_name': row['location_name'], 'total_stock': int(row['total_stock'] or 0)}
+        for row in cursor.fetchall()
+    ]}
+
+def load_top_products_widget(cursor):
+    # Top 5 best-selling products
+    cursor.execute('''
+        SELECT 
+            p.product_name, 
+            SUM(ol.quantity) as total_qty
+        FROM 
+            Order_Line ol
+        JOIN 
+            Product p 
+            ON ol.product_id = p.product_id
+        GROUP BY 
+            ol.product_id
+        ORDER BY 
+            total_qty DESC
+        LIMIT 5
+    ''')
+    return {'top_products': [
+        {'product_name': row['product_name'], 'total_qty': int(row['total_qty'] or 0)}
+        for row in cursor.fetchall()
+    ]}
+
+def load_products_sold_widget(cursor):
+    # Units sold per product, including products never ordered
+    cursor.execute('''
+        SELECT 
+            p.product_id,
+            p.price,
+            IFNULL(sold.total_quantity_sold, 0) AS total_quantity_sold
+        FROM 
+            Product p
+        LEFT JOIN (
+            SELECT product_id, SUM(quantity) AS total_quantity_sold
+            FROM Order_Line
+            GROUP BY product_id
+        ) sold ON sold.product_id = p.product_id
+    ''')
+    return {'products_data': cursor.fetchall()}
+
+def load_profit_widget(cursor):
+    # Units sold and revenue per profit tier (see stats.PROFIT_TIERS)
+    cursor.execute(*profit_tier_query())
+    total_profit, profit_by_tier = summarize_profit(cursor.fetchall())
+    return {'total_profit': total_profit, 'profit_by_tier': profit_by_tier}
+
+# widget name -> (loader, cache TTL in seconds)
+ADMIN_WIDGETS = {
+    'recent_orders': (load_recent_orders_widget, 30),
+    'recent_users': (load_recent_users_widget, 60),
+    'daily_series': (load_daily_series_widget, 300),
+    'category_sales': (load_category_sales_widget, 900),
+    'warehouse_stock': (load_warehouse_stock_widget, 120),
+    'top_products': (load_top_products_widget, 600),
+    'products_sold': (load_products_sold_widget, 600),
+    'profit': (load_profit_widget, 600),
+}
+
+def get_admin_widget(widget):
+    # Cached widget data, shared by admin_widget() and the dashboard page
+    loader, ttl = ADMIN_WIDGETS[widget]
+
+    def load():
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            data = loader(cursor)
+        conn.close()
+        return data
+
+    return admin_widget_cache.get_or_set(widget, load, ttl)
+
+@main.route('/admin/widgets/<widget>')
+def admin_widget(widget):
+    if 'user_id' not in session or session.get('user_role') != 'admin':
+        return jsonify({'error': 'You must be an admin to access the admin dashboard.'}), 403
+    if widget not in ADMIN_WIDGETS:
+        return jsonify({'error': 'Unknown widget.'}), 404
+    _, ttl = ADMIN_WIDGETS[widget]
+    response = jsonify(get_admin_widget(widget))
+    response.cache_control.private = True
+    response.cache_control.max_age = ttl
+    return response
+
 # Admin Products (admin and staff)
 @main.route('/admin/products')
 def admin_products():
@@ -1695,15 +1606,18 @@ def admin_products():
     search = request.args.get('search', '').strip()
     category_id = request.args.get('category', type=int)
     sort = request.args.get('sort', 'product_id_desc') # Default sort by newest product ID
+    if search:
+        search_condition, search_params, relevance, relevance_params = product_search(search)
+    else:
+        relevance, relevance_params = '0', []
 
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal and filter dropdown
-        cursor.execute('SELECT * FROM Category')
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Build the complete query with all filtering and sorting in SQL
-        query = '''
+        query = f'''
             WITH product_stats AS (
                 SELECT 
                     p.product_id,
@@ -1714,6 +1628,7 @@ def admin_products():
                     p.photo,
                     p.category_id,
                     c.category_name,
+                    {relevance} AS relevance,
                     GROUP_CONCAT(s.supplier_name ORDER BY s.supplier_name SEPARATOR ', ') AS suppliers
                 FROM 
                     Product p
@@ -1726,17 +1641,17 @@ def admin_products():
                 WHERE 
                     p.is_active = TRUE
         '''
-        params = []
+        params = list(relevance_params)
 
         # Add category filter
         if category_id:
             query += ' AND p.category_id = %s'
             params.append(category_id)
 
-        # Add search filter
+        # Add search filter (FULLTEXT index on name, brand and description)
         if search:
-            query += ' AND (p.product_name LIKE %s OR p.brand LIKE %s)'
-            params.extend([f'%{search}%', f'%{search}%'])
+            query += ' AND ' + search_condition
+            params.extend(search_params)
 
         # Complete the CTE
         query += '''
@@ -1763,6 +1678,8 @@ def admin_products():
             query += ' ORDER BY ps.category_name ASC'
         elif sort == 'category_desc':
             query += ' ORDER BY ps.category_name DESC'
+        elif sort == 'relevance' and search:
+            query += ' ORDER BY ps.relevance DESC, ps.product_id DESC'
         else:  # Default sort by newest product_id
             query += ' ORDER BY ps.product_id DESC'
 
@@ -1771,8 +1688,7 @@ def admin_products():
         products = cursor.fetchall()
 
         # Fetch all categories again specifically for the filter dropdown
-        cursor.execute('SELECT category_id, category_name FROM Category')
-        all_categories = cursor.fetchall()
+        all_categories = get_categories()
 
     conn.close()
 
@@ -1815,6 +1731,7 @@ def admin_add_product():
         if not all([product_name, brand, price, category_id]):
             flash('Please fill in all required fields (Name, Brand, Price, Category).', 'danger')
         else:
+            product_id = None
             try:
                 price = float(price)
                 category_id = int(category_id)
@@ -1829,21 +1746,24 @@ def admin_add_product():
                         # Insert new product
                         sql = 'INSERT INTO Product (product_name, product_description, brand, price, photo, category_id) VALUES (%s, %s, %s, %s, %s, %s)'
                         cursor.execute(sql, (product_name, product_description, brand, price, photo, category_id))
+                        new_product_id = cursor.lastrowid
                         conn.commit()
-                        flash('Product added successfully!', 'success')
-                        return redirect(url_for('main.admin_products'))
+                        product_id = new_product_id
                 conn.close()
             except ValueError:
                 flash('Invalid Price or Category ID.', 'danger')
             except Exception as e:
                 flash(f'Error adding product: {e}', 'danger')
 
+            # Hooks run only once the product is committed, outside the try
+            if product_id is not None:
+                invalidate_dashboard_cache()
+                product_changed([product_id])
+                flash('Product added successfully!', 'success')
+                return redirect(url_for('main.admin_products'))
+
     # For GET request or POST failure, render the form
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        cursor.execute('SELECT category_id, category_name FROM Category')
-        categories = cursor.fetchall()
-    conn.close()
+    categories = get_categories()
 
     return render_template('admin_add_product.html', categories=categories)
 
@@ -1857,8 +1777,7 @@ def admin_delete_product(product_id):
     try:
         with conn.cursor() as cursor:
             # Check for existing stock in any active warehouse for this product
-            cursor.execute('SELECT SUM(ws.stock_quantity) as total_stock FROM Warehouse_Stock ws JOIN Warehouse w ON ws.warehouse_id = w.warehouse_id WHERE ws.product_id = %s AND w.is_active = TRUE', (product_id,))
-            total_stock = cursor.fetchone()['total_stock'] or 0
+            total_stock = get_product_stock(cursor, product_id)
             if total_stock > 0:
                 flash(f'Cannot archive product: {total_stock} items of this product are still in stock in active warehouses. Please remove all stock first.', 'danger')
                 return redirect(url_for('main.admin_products'))
@@ -1866,8 +1785,6 @@ def admin_delete_product(product_id):
             # If no dependencies, proceed with archiving the product
             cursor.execute('UPDATE Product SET is_active = FALSE WHERE product_id = %s', (product_id,))
             conn.commit()
-        flash('Product has been archived.', 'success')
-        return redirect(url_for('main.admin_products'))
     except Exception as e:
         flash(f'Error archiving product: {e}', 'danger')
         conn.rollback()
@@ -1875,12 +1792,18 @@ def admin_delete_product(product_id):
     finally:
         conn.close()
 
+    invalidate_dashboard_cache()
+    product_changed([product_id])
+    flash('Product has been archived.', 'success')
+    return redirect(url_for('main.admin_products'))
+
 @main.route('/admin/products/edit/<int:product_id>', methods=['GET', 'POST'])
 def admin_edit_product(product_id):
     if 'user_id' not in session or session.get('user_role') not in ['admin', 'staff']:
         flash('You must be an admin or staff to access this page.', 'danger')
         return redirect(url_for('main.home'))
 
+    updated = False
     conn = get_db_connection()
     with conn.cursor() as cursor:
         if request.method == 'POST':
@@ -1930,20 +1853,26 @@ def admin_edit_product(product_id):
                                       category_id, product_id))
                 
                 conn.commit()
-                flash('Product updated successfully!', 'success')
-                return redirect(url_for('main.admin_products'))
+                updated = True
             except ValueError:
                 flash('Invalid Price or Category ID.', 'danger')
             except Exception as e:
                 flash(f'Error updating product: {e}', 'danger')
 
-        # For GET request, fetch product and categories
-        cursor.execute('SELECT * FROM Product WHERE product_id = %s AND is_active = TRUE', (product_id,))
-        product = cursor.fetchone()
-        cursor.execute('SELECT category_id, category_name FROM Category')
-        categories = cursor.fetchall()
+        if not updated:
+            # For GET request, fetch product and categories
+            cursor.execute('SELECT * FROM Product WHERE product_id = %s AND is_active = TRUE', (product_id,))
+            product = cursor.fetchone()
+            categories = get_categories()
     conn.close()
 
+    # Hooks run only once the update is committed, outside the try
+    if updated:
+        invalidate_dashboard_cache()
+        product_changed([product_id])
+        flash('Product updated successfully!', 'success')
+        return redirect(url_for('main.admin_products'))
+
     if not product:
         flash('Product not found.', 'danger')
         return redirect(url_for('main.admin_products'))
@@ -1962,8 +1891,7 @@ def admin_categories():
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories_for_header = cursor.fetchall()
+        categories_for_header = get_categories()
 
         # Build the query for categories table
         query = 'SELECT * FROM Category WHERE is_active = TRUE'
@@ -1994,12 +1922,12 @@ def admin_add_category():
         if not category_name:
             flash('Category name is required.', 'danger')
         else:
+            added = False
             try:
                 conn = get_db_connection()
                 with conn.cursor() as cursor:
                     # Fetch categories for header
-                    cursor.execute('SELECT * FROM Category')
-                    categories = cursor.fetchall()
+                    categories = get_categories()
 
                     # Check if category name already exists
                     cursor.execute('SELECT category_id FROM Category WHERE category_name = %s', (category_name,))
@@ -2012,18 +1940,20 @@ def admin_add_category():
                         cursor.execute('INSERT INTO Category (category_name, category_description) VALUES (%s, %s)',
                                      (category_name, category_description))
                         conn.commit()
-                        flash('Category added successfully!', 'success')
-                        return redirect(url_for('main.admin_categories'))
+                        added = True
                 conn.close()
             except Exception as e:
                 flash(f'Error adding category: {e}', 'danger')
 
+            # Hooks run only once the category is committed, outside the try
+            if added:
+                category_changed()
+                flash('Category added successfully!', 'success')
+                return redirect(url_for('main.admin_categories'))
+
     # For GET request or POST failure, render the form
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        # Fetch categories for header
-        cursor.execute('SELECT * FROM Category')
-        categories = cursor.fetchall()
+    # Fetch categories for header
+    categories = get_categories()
 
     return render_template('admin_add_category.html', categories=categories)
 
@@ -2033,6 +1963,7 @@ def admin_edit_category(category_id):
         flash('You must be an admin or staff to access this page.', 'danger')
         return redirect(url_for('main.home'))
 
+    updated = False
     conn = get_db_connection()
     with conn.cursor() as cursor:
         if request.method == 'POST':
@@ -2055,16 +1986,22 @@ def admin_edit_category(category_id):
                                         WHERE category_id = %s''',
                                      (category_name, category_description, category_id))
                         conn.commit()
-                        flash('Category updated successfully!', 'success')
-                        return redirect(url_for('main.admin_categories'))
+                        updated = True
                 except Exception as e:
                     flash(f'Error updating category: {e}', 'danger')
 
-        # For GET request, fetch category
-        cursor.execute('SELECT * FROM Category WHERE category_id = %s', (category_id,))
-        category = cursor.fetchone()
+        if not updated:
+            # For GET request, fetch category
+            cursor.execute('SELECT * FROM Category WHERE category_id = %s', (category_id,))
+            category = cursor.fetchone()
     conn.close()
 
+    # Hooks run only once the update is committed, outside the try
+    if updated:
+        category_changed()
+        flash('Category updated successfully!', 'success')
+        return redirect(url_for('main.admin_categories'))
+
     if not category:
         flash('Category not found.', 'danger')
         return redirect(url_for('main.admin_categories'))
@@ -2092,8 +2029,6 @@ def admin_delete_category(category_id):
             # Archive the category
             cursor.execute('UPDATE Category SET is_active = FALSE WHERE category_id = %s', (category_id,))
             conn.commit()
-        flash('Category and its products have been archived.', 'success')
-        return redirect(url_for('main.admin_categories'))
     except Exception as e:
         flash(f'Error archiving category: {e}', 'danger')
         conn.rollback()
@@ -2101,6 +2036,10 @@ def admin_delete_category(category_id):
     finally:
         conn.close()
 
+    category_changed()
+    flash('Category and its products have been archived.', 'success')
+    return redirect(url_for('main.admin_categories'))
+
 # Admin Users (admin and staff)
 @main.route('/admin/users')
 def admin_users():
@@ -2114,8 +2053,7 @@ def admin_users():
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Base query
         query = '''
@@ -2194,8 +2132,7 @@ def admin_add_user():
 
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-            categories = cursor.fetchall()
+            categories = get_categories()
             cursor.execute('SELECT * FROM Person WHERE email = %s', (email,))
             if cursor.fetchone():
                 flash('Email already registered.', 'danger')
@@ -2205,14 +2142,12 @@ def admin_add_user():
             hashed_password = generate_password_hash(password).decode('utf-8')
             cursor.execute('INSERT INTO Person (first_name, last_name, email, passcode, role) VALUES (%s, %s, %s, %s, %s)',
                          (first_name, last_name, email, hashed_password, role)) # Use the selected role
+            record_registration_rollup(cursor)
             conn.commit()
         conn.close()
         flash(f'{role.capitalize()} user added successfully!', 'success') # Dynamic flash message
         return redirect(url_for('main.admin_users'))
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+    categories = get_categories()
     return render_template('admin_add_user.html', categories=categories)
 
 @main.route('/admin/users/<int:user_id>')
@@ -2224,8 +2159,7 @@ def admin_user_details(user_id):
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Get user details
         cursor.execute('SELECT * FROM Person WHERE person_id = %s AND is_active = TRUE', (user_id,))
@@ -2367,8 +2301,7 @@ def admin_orders():
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category')
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Build the complete query with all filtering and sorting in SQL
         query = '''
@@ -2480,8 +2413,7 @@ def admin_warehouses():
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Base query
         query = '''
@@ -2533,11 +2465,7 @@ def admin_add_warehouse():
 
         if city not in ALLOWED_CITIES:
             flash('Invalid city selected.', 'danger')
-            conn = get_db_connection() # Re-establish connection to fetch categories for template
-            with conn.cursor() as cursor:
-                cursor.execute('SELECT * FROM Category WHERE is_active = TRUE')
-                categories = cursor.fetchall()
-            conn.close()
+            categories = get_categories(active_only=True)
             return render_template('admin_add_warehouse.html', categories=categories, allowed_cities=ALLOWED_CITIES)
 
         conn = get_db_connection()
@@ -2561,11 +2489,8 @@ def admin_add_warehouse():
             conn.close()
 
     # For GET request or POST failure, render the form
-    conn = get_db_connection()
-    with conn.cursor() as cursor:
-        # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category WHERE is_active = TRUE') # Fetch all categories for modal
-        categories = cursor.fetchall()
+    # Fetch categories for header/modal
+    categories = get_categories(active_only=True)
 
     return render_template('admin_add_warehouse.html', categories=categories, allowed_cities=ALLOWED_CITIES)
 
@@ -2578,8 +2503,7 @@ def admin_warehouse_details(warehouse_id):
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category WHERE is_active = TRUE') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories(active_only=True)
 
         # Get warehouse details
         cursor.execute('SELECT * FROM Warehouse WHERE warehouse_id = %s AND is_active = TRUE', (warehouse_id,))
@@ -2672,10 +2596,11 @@ def admin_delete_warehouse(warehouse_id):
                 return redirect(url_for('main.admin_warehouse_details', warehouse_id=warehouse_id))
 
             # If no stock, proceed with archiving the warehouse
-            cursor.execute('UPDATE Warehouse SET is_active = FALSE WHERE warehouse_id = %s', (warehouse_id,))
+            cursor.execute('UPDATE Warehouse SET is_active = FALSE WHERE warehouse_id = %s AND is_active = TRUE', (warehouse_id,))
+            # Only move the stock totals if this request archived it
+            if cursor.rowcount == 1:
+                set_warehouse_stock_active(cursor, warehouse_id, False)
             conn.commit()
-        flash('Warehouse has been archived.', 'success')
-        return redirect(url_for('main.admin_warehouses'))
     except Exception as e:
         flash(f'Error archiving warehouse: {e}', 'danger')
         conn.rollback()
@@ -2683,6 +2608,11 @@ def admin_delete_warehouse(warehouse_id):
     finally:
         conn.close()
 
+    invalidate_dashboard_cache()
+    stock_changed()
+    flash('Warehouse has been archived.', 'success')
+    return redirect(url_for('main.admin_warehouses'))
+
 @main.route('/admin/warehouses/<int:warehouse_id>/edit', methods=['GET', 'POST'])
 def admin_edit_warehouse(warehouse_id):
     if 'user_id' not in session or session.get('user_role') not in ['admin', 'staff']:
@@ -2717,8 +2647,7 @@ def admin_edit_warehouse(warehouse_id):
     # For GET request or POST failure, fetch warehouse data to pre-fill the form
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         cursor.execute('SELECT * FROM Warehouse WHERE warehouse_id = %s', (warehouse_id,))
         warehouse = cursor.fetchone()
@@ -2740,6 +2669,7 @@ def admin_add_stock(warehouse_id):
     product_id = request.form.get('product_id')
     stock_quantity = request.form.get('stock_quantity')
     conn = None
+    committed = False
     if not all([product_id, stock_quantity]):
         flash('Please select a product and enter a quantity.', 'danger')
         return redirect(url_for('main.admin_warehouse_details', warehouse_id=warehouse_id))
@@ -2753,8 +2683,10 @@ def admin_add_stock(warehouse_id):
 
         conn = get_db_connection()
         with conn.cursor() as cursor:
+            # Lock the product's total before its warehouse row, the same order as checkout
+            get_product_stock(cursor, product_id, for_update=True)
             # Check if the product is already in stock for this warehouse
-            cursor.execute('SELECT stock_quantity FROM Warehouse_Stock WHERE warehouse_id = %s AND product_id = %s', (warehouse_id, product_id))
+            cursor.execute('SELECT stock_quantity FROM Warehouse_Stock WHERE warehouse_id = %s AND product_id = %s FOR UPDATE', (warehouse_id, product_id))
             existing_stock = cursor.fetchone()
 
             if existing_stock:
@@ -2766,8 +2698,10 @@ def admin_add_stock(warehouse_id):
                 # If not exists, insert new stock record
                 cursor.execute('INSERT INTO Warehouse_Stock (warehouse_id, product_id, stock_quantity) VALUES (%s, %s, %s)', (warehouse_id, product_id, stock_quantity))
                 flash(f'Added Product ID {product_id} to stock.', 'success')
+            record_stock_movement(cursor, warehouse_id, product_id, stock_quantity, MOVEMENT_RESTOCK)
 
             conn.commit()
+            committed = True
     except ValueError:
         flash('Invalid product or quantity.', 'danger')
     except Exception as e:
@@ -2775,6 +2709,11 @@ def admin_add_stock(warehouse_id):
     finally:
         if conn:
             conn.close()
+
+    # Hooks run only once the stock change is committed, outside the try
+    if committed:
+        invalidate_dashboard_cache()
+        stock_changed([product_id])
     return redirect(url_for('main.admin_warehouse_details', warehouse_id=warehouse_id))
 
 @main.route('/admin/warehouses/<int:warehouse_id>/update_stock/<int:product_id>', methods=['POST'])
@@ -2784,6 +2723,8 @@ def admin_update_stock(warehouse_id, product_id):
         return redirect(url_for('main.home'))
 
     stock_quantity = request.form.get('stock_quantity')
+    conn = None
+    committed = False
 
     if stock_quantity is None:
         flash('Quantity is required.', 'danger')
@@ -2797,16 +2738,26 @@ def admin_update_stock(warehouse_id, product_id):
 
         conn = get_db_connection()
         with conn.cursor() as cursor:
+            # Lock the product's total before its warehouse row, the same order as checkout
+            get_product_stock(cursor, product_id, for_update=True)
+            # Current quantity, so the ledger records the change rather than the new total
+            cursor.execute('SELECT stock_quantity FROM Warehouse_Stock WHERE warehouse_id = %s AND product_id = %s FOR UPDATE', (warehouse_id, product_id))
+            existing_stock = cursor.fetchone()
+            old_quantity = existing_stock['stock_quantity'] if existing_stock else 0
             if stock_quantity == 0:
                 # If quantity is 0, remove the stock item
                 cursor.execute('DELETE FROM Warehouse_Stock WHERE warehouse_id = %s AND product_id = %s', (warehouse_id, product_id))
+                record_stock_movement(cursor, warehouse_id, product_id, -old_quantity, MOVEMENT_REMOVAL)
                 flash(f'Removed Product ID {product_id} from stock.', 'success')
             else:
                 # Otherwise, update the quantity
                 cursor.execute('UPDATE Warehouse_Stock SET stock_quantity = %s WHERE warehouse_id = %s AND product_id = %s', (stock_quantity, warehouse_id, product_id))
+                if existing_stock:
+                    record_stock_movement(cursor, warehouse_id, product_id, stock_quantity - old_quantity, MOVEMENT_ADJUSTMENT)
                 flash(f'Updated stock for Product ID {product_id}. New quantity: {stock_quantity}', 'success')
 
             conn.commit()
+            committed = True
     except ValueError:
         flash('Invalid quantity.', 'danger')
     except Exception as e:
@@ -2815,6 +2766,11 @@ def admin_update_stock(warehouse_id, product_id):
         if conn:
             conn.close()
 
+    # Hooks run only once the stock change is committed, outside the try
+    if committed:
+        invalidate_dashboard_cache()
+        stock_changed([product_id])
+
     return redirect(url_for('main.admin_warehouse_details', warehouse_id=warehouse_id))
 
 @main.route('/admin/warehouses/<int:warehouse_id>/remove_stock/<int:product_id>', methods=['POST'])
@@ -2826,47 +2782,41 @@ def admin_remove_stock(warehouse_id, product_id):
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
+            # Lock the product's total before its warehouse row, the same order as checkout
+            get_product_stock(cursor, product_id, for_update=True)
+            cursor.execute('SELECT stock_quantity FROM Warehouse_Stock WHERE warehouse_id = %s AND product_id = %s FOR UPDATE', (warehouse_id, product_id))
+            existing_stock = cursor.fetchone()
             cursor.execute('DELETE FROM Warehouse_Stock WHERE warehouse_id = %s AND product_id = %s', (warehouse_id, product_id))
+            if existing_stock:
+                record_stock_movement(cursor, warehouse_id, product_id, -existing_stock['stock_quantity'], MOVEMENT_REMOVAL)
             conn.commit()
-        flash(f'Removed Product ID {product_id} from stock.', 'success')
     except Exception as e:
         flash(f'Error removing stock: {e}', 'danger')
         conn.rollback()
+        return redirect(url_for('main.admin_warehouse_details', warehouse_id=warehouse_id))
     finally:
         conn.close()
 
+    # Hooks run only once the stock change is committed, outside the try
+    invalidate_dashboard_cache()
+    stock_changed([product_id])
+    flash(f'Removed Product ID {product_id} from stock.', 'success')
+
     return redirect(url_for('main.admin_warehouse_details', warehouse_id=warehouse_id))
 
 ############################################################################################################
 # Utility / Context Processor
 ############################################################################################################
+@main.app_context_processor
+def inject_categories():
+    # Header/menu categories for every template; values passed to
+    # render_template take precedence
+    return dict(categories=get_categories(active_only=True))
+
 @main.app_context_processor
 def inject_cart():
-    cart = session.get('cart', {})
-    cart_items = []
-    total = 0
-    if cart:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            product_ids = list(map(int, cart.keys()))
-            if product_ids:
-                format_strings = ','.join(['%s'] * len(product_ids))
-                cursor.execute(f"SELECT * FROM Product WHERE product_id IN ({format_strings})", tuple(product_ids))
-                products = cursor.fetchall()
-            else:
-                products = []
-        conn.close()
-        for product in products:
-            pid = str(product['product_id'])
-            quantity = cart[pid]
-            subtotal = product['price'] * quantity
-            total += subtotal
-            cart_items.append({
-                'product': product,
-                'quantity': quantity,
-                'subtotal': subtotal
-            })
-    return dict(cart_items=cart_items, total=total)
+    # Lazy values: the cart is only priced if a template actually uses it
+    return dict(cart_items=lazy_cart_items, total=lazy_cart_total)
 
 # --- Helper for order status update ---
 def update_order_status_if_needed(order, cursor, today=None):
@@ -2887,14 +2837,19 @@ def update_order_status_if_needed(order, cursor, today=None):
     if order['order_status'] != 'Delivered':
         if days_since_order >= expected_delivery_day:
             print(f"Updating order {order['order_id']} to Delivered. Days since order: {days_since_order}, Expected delivery day: {expected_delivery_day}")
-            cursor.execute('UPDATE Orders SET order_status = %s, delivery_date = %s WHERE order_id = %s',
+            cursor.execute("UPDATE Orders SET order_status = %s, delivery_date = %s WHERE order_id = %s AND order_status <> 'Delivered'",
                            ('Delivered', today.strftime('%Y-%m-%d'), order['order_id']))
+            # Only the request whose UPDATE delivered the order settles it
+            delivered_now = cursor.rowcount == 1
             order['order_status'] = 'Delivered'
             order['delivery_date'] = today.strftime('%Y-%m-%d')
             # Update all order line states to Delivered
             print(f"Updating order line states for order {order['order_id']} to Delivered")
             cursor.execute('UPDATE Order_Line SET order_line_states = %s WHERE order_id = %s',
                            ('Delivered', order['order_id']))
+            # Delivered Cash on Delivery orders now count towards sales
+            if delivered_now:
+                settle_cod_rollup(cursor, order['order_id'])
             status_changed = True
         elif days_since_order >= shipped_day and order['order_status'] == 'Processing':
             print(f"Updating order {order['order_id']} to Shipped. Days since order: {days_since_order}, Shipped day: {shipped_day}")
@@ -2944,8 +2899,7 @@ def admin_suppliers():
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Fetch all suppliers and the count of products they supply
         # Start with the base query
@@ -3036,8 +2990,7 @@ def admin_add_supplier():
     # For GET request or POST failure, render the form
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
     conn.close()
 
     return render_template('admin_add_supplier.html', categories=categories)
@@ -3058,6 +3011,7 @@ def admin_edit_supplier(supplier_id):
         if not supplier_name:
             flash('Supplier name is required.', 'danger')
         else:
+            updated = False
             try:
                 with conn.cursor() as cursor:
                     # Check if supplier name already exists for another supplier (optional)
@@ -3068,18 +3022,22 @@ def admin_edit_supplier(supplier_id):
                         cursor.execute('UPDATE Supplier SET supplier_name = %s, phone_number = %s, email = %s WHERE supplier_id = %s',
                                      (supplier_name, phone_number, email, supplier_id))
                         conn.commit()
-                        flash('Supplier updated successfully!', 'success')
-                        return redirect(url_for('main.admin_suppliers'))
+                        updated = True
             except Exception as e:
                 flash(f'Error updating supplier: {e}', 'danger')
             finally:
                 conn.close()
 
+            # Hooks run only once the update is committed, outside the try
+            if updated:
+                product_changed()
+                flash('Supplier updated successfully!', 'success')
+                return redirect(url_for('main.admin_suppliers'))
+
     # For GET request or POST failure, fetch supplier data to pre-fill the form
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category') # Fetch all categories for modal
-        categories = cursor.fetchall()
+        categories = get_categories()
         
         # Fetch supplier details
         cursor.execute('SELECT * FROM Supplier WHERE supplier_id = %s', (supplier_id,))
@@ -3147,8 +3105,6 @@ def admin_delete_supplier(supplier_id):
 
             cursor.execute('UPDATE Supplier SET is_active = FALSE WHERE supplier_id = %s', (supplier_id,))
             conn.commit()
-        flash('Supplier has been archived.', 'success')
-        return redirect(url_for('main.admin_suppliers'))
     except Exception as e:
         flash(f'Error archiving supplier: {e}', 'danger')
         conn.rollback()
@@ -3156,6 +3112,10 @@ def admin_delete_supplier(supplier_id):
     finally:
         conn.close()
 
+    product_changed()
+    flash('Supplier has been archived.', 'success')
+    return redirect(url_for('main.admin_suppliers'))
+
 # Admin Add Product to Supplier (admin and staff)
 @main.route('/admin/suppliers/<int:supplier_id>/add_product', methods=['POST'])
 def admin_add_product_to_supplier(supplier_id):
@@ -3165,6 +3125,7 @@ def admin_add_product_to_supplier(supplier_id):
 
     product_id = request.form.get('product_id')
     conn = None
+    linked = False
     if not product_id:
         flash('Please select a product.', 'danger')
         return redirect(url_for('main.admin_edit_supplier', supplier_id=supplier_id))
@@ -3180,7 +3141,7 @@ def admin_add_product_to_supplier(supplier_id):
             else:
                 cursor.execute('INSERT INTO Supplier_Product (supplier_id, product_id) VALUES (%s, %s)', (supplier_id, product_id))
                 conn.commit()
-                flash('Product linked to supplier successfully!', 'success')
+                linked = True
     except ValueError:
         flash('Invalid product ID.', 'danger')
     except Exception as e:
@@ -3189,6 +3150,11 @@ def admin_add_product_to_supplier(supplier_id):
     finally:
         if conn: conn.close()
 
+    # Hooks run only once the link is committed, outside the try
+    if linked:
+        product_changed([product_id])
+        flash('Product linked to supplier successfully!', 'success')
+
     return redirect(url_for('main.admin_edit_supplier', supplier_id=supplier_id))
 
 # Admin Remove Product from Supplier (admin and staff)
@@ -3204,13 +3170,17 @@ def admin_remove_product_from_supplier(supplier_id, product_id):
         with conn.cursor() as cursor:
             cursor.execute('DELETE FROM Supplier_Product WHERE supplier_id = %s AND product_id = %s', (supplier_id, product_id))
             conn.commit()
-            flash('Product unlinked from supplier successfully!', 'success')
     except Exception as e:
         flash(f'Error unlinking product: {e}', 'danger')
         if conn: conn.rollback()
+        return redirect(url_for('main.admin_edit_supplier', supplier_id=supplier_id))
     finally:
         if conn: conn.close()
 
+    # Hooks run only once the unlink is committed, outside the try
+    product_changed([product_id])
+    flash('Product unlinked from supplier successfully!', 'success')
+
     return redirect(url_for('main.admin_edit_supplier', supplier_id=supplier_id))
 
 # Admin Archives (admin only)
@@ -3225,8 +3195,7 @@ def admin_archives():
     conn = get_db_connection()
     with conn.cursor() as cursor:
         # Fetch categories for header/modal
-        cursor.execute('SELECT * FROM Category')
-        categories = cursor.fetchall()
+        categories = get_categories()
 
         # Fetch archived users
         user_query = 'SELECT * FROM Person WHERE is_active = FALSE'
@@ -3320,6 +3289,8 @@ def admin_restore_product(product_id):
         cursor.execute('UPDATE Product SET is_active = TRUE WHERE product_id = %s', (product_id,))
         conn.commit()
     conn.close()
+    invalidate_dashboard_cache()
+    product_changed([product_id])
     flash('Product has been restored.', 'success')
     return redirect(url_for('main.admin_archives'))
 
@@ -3335,6 +3306,7 @@ def admin_restore_category(category_id):
         cursor.execute('UPDATE Product SET is_active = TRUE WHERE category_id = %s', (category_id,))
         conn.commit()
     conn.close()
+    category_changed()
     flash('Category and its products have been restored.', 'success')
     return redirect(url_for('main.admin_archives'))
 
@@ -3349,6 +3321,7 @@ def admin_restore_supplier(supplier_id):
         cursor.execute('UPDATE Supplier SET is_active = TRUE WHERE supplier_id = %s', (supplier_id,))
         conn.commit()
     conn.close()
+    product_changed()
     flash('Supplier has been restored.', 'success')
     return redirect(url_for('main.admin_archives'))
 
@@ -3360,9 +3333,14 @@ def admin_restore_warehouse(warehouse_id):
 
     conn = get_db_connection()
     with conn.cursor() as cursor:
-        cursor.execute('UPDATE Warehouse SET is_active = TRUE WHERE warehouse_id = %s', (warehouse_id,))
+        cursor.execute('UPDATE Warehouse SET is_active = TRUE WHERE warehouse_id = %s AND is_active = FALSE', (warehouse_id,))
+        # A repeated restore must not add the warehouse's stock twice
+        if cursor.rowcount == 1:
+            set_warehouse_stock_active(cursor, warehouse_id, True)
         conn.commit()
     conn.close()
+    invalidate_dashboard_cache()
+    stock_changed()
     flash('Warehouse has been restored.', 'success')
     return redirect(url_for('main.admin_archives'))
 
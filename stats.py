@@ -0,0 +1,381 @@
+from datetime import date
+
+from app.cache import dashboard_cache
+from app.inventory import stock_levels_by_month
+
+
+def last_n_months(n, today=None):
+    # First day of each of the last n calendar months, oldest first
+    today = today or date.today()
+    year, month = today.year, today.month
+    months = []
+    for _ in range(n):
+        months.append(date(year, month, 1))
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    months.reverse()
+    return months
+
+
+def next_month(month_start):
+    if month_start.month == 12:
+        return date(month_start.year + 1, 1, 1)
+    return date(month_start.year, month_start.month + 1, 1)
+
+
+def month_key(dt):
+    return dt.strftime('%Y-%m')
+
+
+def monthly_chart_data(cursor, n_months=6):
+    # Orders, cumulative product counts and stock levels per calendar month,
+    # computed for the whole window with one GROUP BY query each
+    month_starts = last_n_months(n_months)
+    window_start = month_starts[0]
+    window_end = next_month(month_starts[-1])
+    keys = [month_key(m) for m in month_starts]
+
+    cursor.execute('''
+        SELECT
+            DATE_FORMAT(order_date, '%%Y-%%m') AS month_key,
+            COUNT(*) AS order_count
+        FROM
+            Orders
+        WHERE
+            order_date >= %s AND order_date < %s
+        GROUP BY
+            month_key
+    ''', (window_start, window_end))
+    order_rows = {row['month_key']: row['order_count'] for row in cursor.fetchall()}
+
+    # Products created before the window are folded into the '' bucket
+    cursor.execute('''
+        SELECT
+            CASE
+                WHEN created_at < %s THEN ''
+                ELSE DATE_FORMAT(created_at, '%%Y-%%m')
+            END AS month_key,
+            COUNT(*) AS count
+        FROM
+            Product
+        WHERE
+            is_active = TRUE AND created_at < %s
+        GROUP BY
+            month_key
+    ''', (window_start, window_end))
+    product_rows = {row['month_key']: row['count'] for row in cursor.fetchall()}
+
+    orders_per_month = []
+    products_over_time = []
+    running_products = product_rows.get('', 0)
+    for key in keys:
+        orders_per_month.append(order_rows.get(key, 0))
+        running_products += product_rows.get(key, 0)
+        products_over_time.append(running_products)
+
+    return {
+        'months': [m.strftime('%b %Y') for m in month_starts],
+        'orders_per_month': orders_per_month,
+        'products_over_time': products_over_time,
+        'stocks_over_time': stock_levels_by_month(cursor, month_starts, window_end),
+    }
+
+
+# --- Featured products ---
+
+FEATURED_QUERY = '''
+    (
+        SELECT p.*, c.category_name, 'highest_price' AS feature_type, p.price AS feature_score
+        FROM Product p
+        JOIN Category c ON p.category_id = c.category_id
+        WHERE p.is_active = TRUE
+        ORDER BY p.price DESC, p.product_id DESC
+        LIMIT 3
+    )
+    UNION ALL
+    (
+        SELECT p.*, c.category_name, 'lowest_price' AS feature_type, -p.price AS feature_score
+        FROM Product p
+        JOIN Category c ON p.category_id = c.category_id
+        WHERE p.is_active = TRUE
+        ORDER BY p.price ASC, p.product_id DESC
+        LIMIT 3
+    )
+    UNION ALL
+    (
+        SELECT p.*, c.category_name, 'newest' AS feature_type, p.product_id AS feature_score
+        FROM Product p
+        JOIN Category c ON p.category_id = c.category_id
+        WHERE p.is_active = TRUE
+        ORDER BY p.product_id DESC
+        LIMIT 12
+    )
+    UNION ALL
+    (
+        SELECT p.*, c.category_name, 'most_ordered' AS feature_type, ps.order_count AS feature_score
+        FROM Product_Stats ps
+        JOIN Product p ON ps.product_id = p.product_id
+        JOIN Category c ON p.category_id = c.category_id
+        WHERE p.is_active = TRUE AND ps.order_count > 0
+        ORDER BY ps.order_count DESC, p.product_id DESC
+        LIMIT 8
+    )
+'''
+
+
+def compute_featured_products(cursor):
+    # All four rankings in one round trip; "most ordered" reads the maintained
+    # Product_Stats counters instead of aggregating Order_Line
+    cursor.execute(FEATURED_QUERY)
+    rankings = {'highest_price': [], 'lowest_price': [], 'newest': [], 'most_ordered': []}
+    for row in cursor.fetchall():
+        rankings[row['feature_type']].append(row)
+    # UNION ALL does not keep each branch's order, so re-sort every ranking
+    for products in rankings.values():
+        products.sort(key=lambda p: (p['feature_score'], p['product_id']), reverse=True)
+
+    # Top up with never-ordered products, like the old LEFT JOIN ranking did
+    most_ordered = rankings['most_ordered']
+    seen = {p['product_id'] for p in most_ordered}
+    for product in rankings['newest']:
+        if len(most_ordered) >= 8:
+            break
+        if product['product_id'] not in seen:
+            most_ordered.append(dict(product, feature_type='most_ordered', feature_score=0))
+            seen.add(product['product_id'])
+
+    featured_products = (
+        rankings['highest_price'][:2] +
+        rankings['lowest_price'][:2] +
+        rankings['newest'][:2] +
+        most_ordered[:2]
+    )
+    return {
+        'featured_products': featured_products,
+        'newest_products': rankings['newest'],
+        'most_ordered_products': most_ordered,
+    }
+
+
+def get_featured_products(cursor, ttl=300):
+    return dashboard_cache.get_or_set('featured', lambda: compute_featured_products(cursor), ttl)
+
+
+def record_product_orders(cursor, lines):
+    # lines: [(product_id, quantity), ...] for one new order
+    cursor.executemany('''
+        INSERT INTO Product_Stats (product_id, order_count, units_ordered)
+        VALUES (%s, 1, %s)
+        ON DUPLICATE KEY UPDATE
+            order_count = order_count + 1,
+            units_ordered = units_ordered + VALUES(units_ordered)
+    ''', lines)
+
+
+def rebuild_product_stats(cursor):
+    cursor.execute('DELETE FROM Product_Stats')
+    cursor.execute('''
+        INSERT INTO Product_Stats (product_id, order_count, units_ordered)
+        SELECT
+            product_id,
+            COUNT(*),
+            IFNULL(SUM(quantity), 0)
+        FROM
+            Order_Line
+        GROUP BY
+            product_id
+    ''')
+
+
+# --- Profit tiers ---
+
+# (upper price bound, margin on price, fixed profit per unit); None = no upper bound
+PROFIT_TIERS = [
+    (10.00, 0.40, 1.50),
+    (50.00, 0.30, 2.00),
+    (150.00, 0.25, 0.00),
+    (500.00, 0.20, 0.00),
+    (1000.00, 0.15, 0.00),
+    (2500.00, 0.12, 0.00),
+    (5000.00, 0.10, 0.00),
+    (None, 0.08, 0.00),
+]
+
+
+def profit_tier_query():
+    # Revenue and units sold per price tier, grouped server-side from
+    # Order_Line so the figure is exact. Profit is linear in both
+    # (price * rate + fixed) * qty, so the totals are enough.
+    cases = []
+    params = []
+    for index, (upper, _, _) in enumerate(PROFIT_TIERS):
+        if upper is None:
+            cases.append(f'ELSE {index}')
+        else:
+            cases.append(f'WHEN p.price <= %s THEN {index}')
+            params.append(upper)
+    sql = f'''
+        SELECT
+            CASE {' '.join(cases)} END AS tier,
+            IFNULL(SUM(p.price * sold.units), 0) AS revenue,
+            IFNULL(SUM(sold.units), 0) AS units
+        FROM (
+            SELECT product_id, SUM(quantity) AS units
+            FROM Order_Line
+            GROUP BY product_id
+        ) sold
+        JOIN
+            Product p ON sold.product_id = p.product_id
+        GROUP BY
+            tier
+    '''
+    return sql, tuple(params)
+
+
+def summarize_profit(rows):
+    by_tier = {row['tier']: row for row in rows}
+    total_profit = 0
+    profit_by_tier = []
+    lower = None
+    for index, (upper, rate, fixed) in enumerate(PROFIT_TIERS):
+        row = by_tier.get(index)
+        revenue = float(row['revenue']) if row else 0.0
+        units = int(row['units']) if row else 0
+        profit = revenue * rate + units * fixed
+        total_profit += profit
+        if lower is None:
+            label = f'Up to ${upper:,.2f}'
+        elif upper is None:
+            label = f'Over ${lower:,.2f}'
+        else:
+            label = f'${lower:,.2f} - ${upper:,.2f}'
+        profit_by_tier.append({'tier': label, 'units_sold': units, 'revenue': revenue, 'profit': profit})
+        lower = upper
+    return total_profit, profit_by_tier
+
+
+# --- Daily rollups ---
+# One Daily_Rollup row per day, updated in the same transaction as the order
+# or registration. Sales follow the dashboard rule: Cash on Delivery only
+# counts once delivered, so pending COD is tracked separately. The amount
+# each pending COD order added is kept in Pending_Cod_Order, so delivery
+# takes off exactly that amount even if prices changed in between.
+
+# Per-order totals at current prices, for rebuilding from history
+ORDER_TOTALS = '''
+    SELECT
+        ol.order_id,
+        SUM(ol.quantity) AS items,
+        SUM(ol.quantity * p.price) AS gross_sales
+    FROM
+        Order_Line ol
+    JOIN
+        Product p ON ol.product_id = p.product_id
+    GROUP BY
+        ol.order_id
+'''
+
+# Daily_Rollup rows (rollup_date, orders, items, gross_sales,
+# cod_pending_sales, registrations) rebuilt from Orders and Person
+DAILY_ROLLUP_HISTORY = f'''
+    SELECT
+        day,
+        SUM(orders) AS orders,
+        SUM(items) AS items,
+        SUM(gross_sales) AS gross_sales,
+        SUM(cod_pending_sales) AS cod_pending_sales,
+        SUM(registrations) AS registrations
+    FROM (
+        SELECT
+            DATE(o.order_date) AS day,
+            1 AS orders,
+            IFNULL(t.items, 0) AS items,
+            IFNULL(t.gross_sales, 0) AS gross_sales,
+            CASE
+                WHEN pay.payment_method = 'Cash on Delivery' AND o.order_status != 'Delivered'
+                THEN IFNULL(t.gross_sales, 0)
+                ELSE 0
+            END AS cod_pending_sales,
+            0 AS registrations
+        FROM
+            Orders o
+        LEFT JOIN ({ORDER_TOTALS}) t ON t.order_id = o.order_id
+        LEFT JOIN
+            Payment pay ON pay.order_id = o.order_id
+        UNION ALL
+        SELECT
+            DATE(created_at), 0, 0, 0, 0, 1
+        FROM
+            Person
+    ) activity
+    GROUP BY
+        day
+'''
+
+# Pending_Cod_Order rows (order_id, rollup_date, amount) for undelivered
+# Cash on Delivery orders, matching cod_pending_sales in DAILY_ROLLUP_HISTORY
+PENDING_COD_HISTORY = f'''
+    SELECT
+        o.order_id,
+        DATE(o.order_date) AS rollup_date,
+        IFNULL(t.gross_sales, 0) AS amount
+    FROM
+        Orders o
+    JOIN
+        Payment pay ON pay.order_id = o.order_id
+    LEFT JOIN ({ORDER_TOTALS}) t ON t.order_id = o.order_id
+    WHERE
+        pay.payment_method = 'Cash on Delivery' AND o.order_status != 'Delivered'
+'''
+
+
+def record_order_rollup(cursor, order_id, items, gross_sales, cash_on_delivery):
+    cod_pending = gross_sales if cash_on_delivery else 0
+    cursor.execute('''
+        INSERT INTO Daily_Rollup (rollup_date, orders, items, gross_sales, cod_pending_sales)
+        VALUES (CURDATE(), 1, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            orders = orders + 1,
+            items = items + VALUES(items),
+            gross_sales = gross_sales + VALUES(gross_sales),
+            cod_pending_sales = cod_pending_sales + VALUES(cod_pending_sales)
+    ''', (items, gross_sales, cod_pending))
+    if cash_on_delivery:
+        cursor.execute(
+            'INSERT INTO Pending_Cod_Order (order_id, rollup_date, amount) VALUES (%s, CURDATE(), %s)',
+            (order_id, cod_pending)
+        )
+
+
+def record_registration_rollup(cursor):
+    cursor.execute('''
+        INSERT INTO Daily_Rollup (rollup_date, registrations)
+        VALUES (CURDATE(), 1)
+        ON DUPLICATE KEY UPDATE
+            registrations = registrations + 1
+    ''')
+
+
+def settle_cod_rollup(cursor, order_id):
+    # A Cash on Delivery order was delivered: the amount it added is no longer pending
+    cursor.execute('''
+        UPDATE Daily_Rollup r
+        JOIN Pending_Cod_Order c ON r.rollup_date = c.rollup_date
+        SET r.cod_pending_sales = r.cod_pending_sales - c.amount
+        WHERE c.order_id = %s
+    ''', (order_id,))
+    cursor.execute('DELETE FROM Pending_Cod_Order WHERE order_id = %s', (order_id,))
+
+
+def rebuild_daily_rollups(cursor):
+    cursor.execute('DELETE FROM Daily_Rollup')
+    cursor.execute(f'''
+        INSERT INTO Daily_Rollup (rollup_date, orders, items, gross_sales, cod_pending_sales, registrations)
+        {DAILY_ROLLUP_HISTORY}
+    ''')
+    cursor.execute('DELETE FROM Pending_Cod_Order')
+    cursor.execute(f'''
+        INSERT INTO Pending_Cod_Order (order_id, rollup_date, amount)
+        {PENDING_COD_HISTORY}
+    ''')